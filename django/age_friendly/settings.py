@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -127,3 +128,51 @@ STATICFILES_DIRS = [Path.joinpath(BASE_DIR, "static")]
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 LOGIN_URL = "login"
+
+# Local .osm/.osm.pbf extract used instead of live Overpass queries (optional)
+OSM_EXTRACT_PATH = os.environ.get("OSM_EXTRACT_PATH")
+
+# Preprocessed OSM layers are stored here as GeoParquet snapshots
+SNAPSHOT_DIR = BASE_DIR / "cache" / "snapshots"
+SNAPSHOT_TTL_DAYS = int(os.environ.get("SNAPSHOT_TTL_DAYS", 7))
+
+# Persistent geocoding cache (points as JSON, boundaries in the snapshot store)
+GEOCODE_CACHE_DIR = BASE_DIR / "cache" / "geocoding"
+GEOCODE_TTL_DAYS = int(os.environ.get("GEOCODE_TTL_DAYS", 90))
+
+# Overpass API endpoint (a local server can stand in for it) and the
+# persistent cache of its responses
+OVERPASS_URL = os.environ.get("OVERPASS_URL", "https://overpass-api.de/api/interpreter")
+OVERPASS_TIMEOUT = int(os.environ.get("OVERPASS_TIMEOUT", 180))
+OVERPASS_CACHE_DIR = BASE_DIR / "cache" / "overpass"
+OVERPASS_TTL_DAYS = int(os.environ.get("OVERPASS_TTL_DAYS", 7))
+
+# Heatmap workbooks compiled to GeoParquet, keyed by the file content hash
+HEATMAP_CACHE_DIR = BASE_DIR / "cache" / "heatmaps"
+
+# Analysis jobs run in local worker processes, status and results are kept here
+JOB_DIR = BASE_DIR / "cache" / "jobs"
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+
+# Downloads of the analysis run concurrently in a pool of threads, a download
+# taking longer than the timeout (in seconds) fails the analysis
+STAGE_WORKERS = int(os.environ.get("STAGE_WORKERS", 8))
+STAGE_TIMEOUT = int(os.environ.get("STAGE_TIMEOUT", 300))
+
+# Analysis results (classified layers and statistics) by their inputs
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "analysis": {
+        "BACKEND": os.environ.get(
+            "ANALYSIS_CACHE_BACKEND",
+            "django.core.cache.backends.filebased.FileBasedCache",
+        ),
+        "LOCATION": os.environ.get(
+            "ANALYSIS_CACHE_LOCATION", str(BASE_DIR / "cache" / "analysis")
+        ),
+        "TIMEOUT": int(os.environ.get("ANALYSIS_CACHE_TTL_DAYS", 7)) * 24 * 60 * 60,
+        "OPTIONS": {"MAX_ENTRIES": 500},
+    },
+}
@@ -24,9 +24,21 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     path("", views.index, name="home"),
     path("show_heatmap/", views.show_heatmap, name="show_heatmap"),
+    path(
+        "heatmap_tiles/<str:digest>/<int:z>/<int:x>/<int:y>.png",
+        views.heatmap_tiles,
+        name="heatmap_tiles",
+    ),
     path("settings/", views.settings_view, name="settings"),
     path("login", views.login_view, name="login"),
     path("logout", views.logout_view, name="logout"),
     path("show_map/", views.show_map, name="show_map"),
+    path("map/", views.map_page, name="map_page"),
+    path("map_data/", views.map_data, name="map_data"),
+    path("jobs/", views.submit_analysis, name="submit_analysis"),
+    path("jobs/<slug:job_id>/", views.job_status, name="job_status"),
+    path("jobs/<slug:job_id>/cancel/", views.cancel_analysis, name="cancel_analysis"),
+    path("jobs/<slug:job_id>/result/", views.job_result, name="job_result"),
     path("get_districts/", views.get_districts, name="get_districts"),
+    path("simulation_curve/", views.simulation_curve, name="simulation_curve"),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
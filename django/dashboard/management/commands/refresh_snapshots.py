@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from utils.benches_sidewalks import get_benches, get_sidewalks
+from utils.districts import get_district_geodataframe
+
+
+class Command(BaseCommand):
+    help = "Fetch the OSM layers of the given places again and store fresh snapshots."
+
+    def add_arguments(self, parser):
+        parser.add_argument("locations", nargs="+", help='e.g. "Poznań, Jeżyce"')
+        parser.add_argument(
+            "--admin-level", type=int, help="Level the districts were picked from"
+        )
+
+    def handle(self, *args, **options):
+        admin_level = options["admin_level"]
+        for location_name in options["locations"]:
+            district = get_district_geodataframe(location_name, admin_level, refresh=True)
+            sidewalks_gdf = get_sidewalks(location_name, admin_level, refresh=True)
+            benches_gdf = get_benches(
+                location_name, district, admin_level=admin_level, refresh=True
+            )
+            self.stdout.write(
+                f"{location_name}: {len(sidewalks_gdf)} sidewalks, {len(benches_gdf)} benches"
+            )
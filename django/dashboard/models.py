@@ -1,5 +1,6 @@
 from django.db import models
 from django.conf import settings
+from utils.heatmap_data import discard_heatmap
 
 
 class AppSettings(models.Model):
@@ -42,6 +43,8 @@ class AppSettings(models.Model):
                 old_instance = AppSettings.objects.get(pk=self.pk)
                 # If the new file is different from the old one, delete the old file
                 if old_instance.heatmap_file != self.heatmap_file:
+                    # Drop the compiled heatmap together with the file
+                    discard_heatmap(old_instance.heatmap_file)
                     old_instance.heatmap_file.delete(save=False)
                     old_instance.heatmap_file.name = None
             except AppSettings.DoesNotExist:
@@ -1,16 +1,35 @@
 # views.py
+import json
 import locale
-import requests
 from .models import AppSettings
 from django.conf import settings
 from django.shortcuts import render
 from django.contrib import messages
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import redirect, render
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
-
-from osm.interface import get_map, get_heatmap
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition
+
+from osm.interface import (
+    get_map,
+    get_map_data,
+    get_analysis_key,
+    get_street_colors,
+    get_heatmap,
+    get_heatmap_tile,
+    get_simulation_curve,
+)
+from osm.stages import StageTimeout
+from osm.jobs import (
+    cancel_job,
+    read_result,
+    read_status,
+    submit_job,
+)
+from utils.districts import get_districts as find_districts
+from utils.heatmap_data import discard_heatmap
 
 
 locale.setlocale(locale.LC_COLLATE, "pl_PL.UTF-8")
@@ -55,6 +74,7 @@ def settings_view(request):
         )
         delete_heatmap = request.POST.get("delete_heatmap")
         if delete_heatmap:
+            discard_heatmap(app_settings.heatmap_file)
             app_settings.heatmap_file.delete(save=False)
             app_settings.heatmap_file.name = None
 
@@ -135,11 +155,25 @@ def show_heatmap(request):
             return JsonResponse({"heatmap_html": "Error: Please select a city."})
 
         # Generate the heatmap
-        heatmap = get_heatmap(request.user, city)
+        heatmap = get_heatmap(
+            request.user, city, raster="raster_heatmap" in request.POST
+        )
 
         return JsonResponse({"heatmap_html": heatmap._repr_html_()})
 
 
+@login_required
+def heatmap_tiles(request, digest, z, x, y):
+    tile = get_heatmap_tile(request.user, digest, z, x, y)
+    if tile is None:
+        raise Http404("Heatmap not found.")
+
+    # Tiles are keyed by the content hash of the heatmap file
+    response = HttpResponse(tile, content_type="image/png")
+    response["Cache-Control"] = "private, max-age=31536000, immutable"
+    return response
+
+
 @login_required
 def get_districts(request):
     # Doesn't even work that well (e.g. no Łacina)
@@ -150,24 +184,8 @@ def get_districts(request):
     settings = AppSettings.objects.get(user=request.user)
     admin_level = settings.admin_level
 
-    query = f"""
-    [out:json];
-    area[name="{city_name}"]->.searchArea;
-    (
-      rel(area.searchArea)["admin_level"="{admin_level}"];
-    );
-    out body;
-    """
-
-    # URL of the Overpass API
-    url = "http://overpass-api.de/api/interpreter"
-
-    # Send request to Overpass API
-    response = requests.get(url, params={"data": query})
-    data = response.json()
-
-    # Extract district names
-    districts = [element["tags"]["name"] for element in data["elements"]]
+    # District names come from the catalogue of the city, fetched once for all levels
+    districts = find_districts(city_name, admin_level)
 
     # Sort districts alphabetically
     districts.sort(key=locale.strxfrm)
@@ -194,16 +212,139 @@ def show_map(request):
             "zero_streets": "show_empty" in request.POST,
         }
 
-        map = get_map(
+        # The map page runs the analysis as a cancellable job instead
+        try:
+            map = get_map(
+                request.user,
+                location_name=f"{city}, {district}",
+                show_benches="show_benches" in request.POST,
+                show_options=show_options,
+                good_distance=int(request.POST.get("good_distance", "50")),
+                okay_distance=int(request.POST.get("okay_distance", "150")),
+                simulation="simulation" in request.POST,
+                budget=request.POST.get("budget", None),
+                bench_cost=request.POST.get("bench_cost", None),
+            )
+        except StageTimeout as e:
+            return JsonResponse({"map_html": f"Error: {e}"})
+
+        return JsonResponse({"map_html": map})
+
+
+def _map_data_parameters(params):
+    return {
+        "location_name": f"{params.get('city')}, {params.get('district')}",
+        "good_distance": int(params.get("good_distance", "50")),
+        "okay_distance": int(params.get("okay_distance", "150")),
+        "simulation": "simulation" in params,
+        "budget": params.get("budget", ""),
+        "bench_cost": params.get("bench_cost", ""),
+    }
+
+
+def map_data_etag(request):
+    if request.GET.get("city") is None or request.GET.get("district") is None:
+        return None
+    return get_analysis_key(request.user, **_map_data_parameters(request.GET))
+
+
+@login_required
+@gzip_page
+@condition(etag_func=map_data_etag)
+def map_data(request):
+    # Classified sidewalks, benches and statistics without any styling, for
+    # API clients. The map page gets the same data from a job instead (see
+    # `submit_analysis`), which does not hold the request for the analysis
+    if request.GET.get("city") is None or request.GET.get("district") is None:
+        return JsonResponse({"error": "City or district not specified."}, status=400)
+
+    data = get_map_data(request.user, **_map_data_parameters(request.GET))
+
+    # Revalidate every time, unchanged data is answered with 304 Not Modified
+    response = JsonResponse(data)
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@login_required
+def submit_analysis(request):
+    # Start the analysis in the background, the job id is the hash of its
+    # inputs so repeated submissions return the same job
+    if request.method == "POST":
+        if request.POST.get("city") is None or request.POST.get("district") is None:
+            return JsonResponse({"error": "City or district not specified."}, status=400)
+
+        params = _map_data_parameters(request.POST)
+        job_id = get_analysis_key(request.user, **params)
+        return JsonResponse(submit_job(job_id, request.user, params))
+
+
+@login_required
+def job_status(request, job_id):
+    status = read_status(job_id)
+    if status is None:
+        raise Http404("Job not found.")
+    return JsonResponse(status)
+
+
+@login_required
+def cancel_analysis(request, job_id):
+    # Stop the job at its next stage, other clients following it see it fail
+    if request.method == "POST":
+        status = cancel_job(job_id)
+        if status is None:
+            raise Http404("Job not found.")
+        return JsonResponse(status)
+
+
+def job_result_etag(request, job_id):
+    # Results never change for a job id, which is the hash of the inputs
+    status = read_status(job_id)
+    return job_id if status is not None and status["status"] == "done" else None
+
+
+@login_required
+@gzip_page
+@condition(etag_func=job_result_etag)
+def job_result(request, job_id):
+    # Same data as `map_data`, computed by the job
+    result = read_result(job_id)
+    if result is None:
+        raise Http404("Result not found.")
+    response = HttpResponse(result, content_type="application/json")
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@login_required
+def map_page(request):
+    # Static page, the data is loaded from the result of an analysis job
+    return render(request, "map.html", {"colors": get_street_colors(request.user)})
+
+
+@login_required
+def simulation_curve(request):
+    # Budget curve shown below the simulated map
+    if request.method == "POST":
+        # Get form data
+        city = request.POST.get("city")
+        district = request.POST.get("district")
+        budget = request.POST.get("budget", "")
+        bench_cost = request.POST.get("bench_cost", "")
+
+        # Check if valid
+        if city is None or district is None:
+            return JsonResponse({"error": "City or district not specified."})
+        if budget == "" or bench_cost == "":
+            return JsonResponse({"error": "Budget or bench cost not specified."})
+
+        curve = get_simulation_curve(
             request.user,
             location_name=f"{city}, {district}",
-            show_benches="show_benches" in request.POST,
-            show_options=show_options,
-            good_distance=int(request.POST.get("good_distance", "50")) / 111320,
-            okay_distance=int(request.POST.get("okay_distance", "150")) / 111320,
-            simulation="simulation" in request.POST,
-            budget=request.POST.get("budget", None),
-            bench_cost=request.POST.get("bench_cost", None),
+            good_distance=int(request.POST.get("good_distance", "50")),
+            okay_distance=int(request.POST.get("okay_distance", "150")),
+            budget=float(budget),
+            bench_cost=float(bench_cost),
         )
 
-        return JsonResponse({"map_html": map})
+        return JsonResponse({"curve": json.loads(curve.to_json(orient="records"))})
@@ -1,98 +1,307 @@
 import os
+import json
+import hashlib
+from collections import namedtuple
+from datetime import timedelta
 import folium
 import numpy as np
 import osmnx as ox
 import pandas as pd
 import geopandas as gpd
-from geopy.geocoders import Nominatim
 from dashboard.models import AppSettings
 from shapely.geometry import Point, Polygon, MultiPoint, LineString
 from django.conf import settings
+from django.core.cache import caches
+from django.urls import reverse
+from osm.stages import (
+    check_cancelled,
+    run_stages,
+    start_stages,
+    stop_stages,
+    wait_for_stages,
+)
 from utils.statistics import *
 from utils.benches_sidewalks import *
 from utils.simulation import *
 from utils.drawing import *
 from utils.classification import *
+from utils.districts import get_district_geodataframe
+from utils.geocoding import geocode
+from utils.heatmap_data import file_digest, heatmap_path, load_heatmap
+from utils.heatmap_tiles import TILE_SIZE, heatmap_tile
+from utils.projection import get_metric_crs, to_crs
+from utils.snapshots import snapshot_stamp
+
+# Bump when the analysis changes so that cached results and client copies of
+# the map data are not reused
+ANALYSIS_VERSION = 1
+
+# District, sidewalks with their benches assigned and benches in the metric
+# CRS, and the gap profiles of the sidewalks. They do not depend on the
+# thresholds, so changing those only classifies the sidewalks again
+Inputs = namedtuple("Inputs", ["district", "sidewalks", "benches", "profiles"])
+
+
+def _static_file_digest(field_file):
+    if not field_file:
+        return None
+    return file_digest(os.path.join(settings.STATICFILES_DIRS[0], field_file.name))
+
+
+def _hash_key(fields):
+    key = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+def _inputs_fields(app_settings, location_name):
+    # Everything the inputs of the analysis depend on: the imported benches
+    # and the stored OSM snapshots
+    return {
+        "version": ANALYSIS_VERSION,
+        "location": location_name,
+        "highway_types": SIDEWALK_TAGS["highway"],
+        "benches_file": _static_file_digest(app_settings.benches_file),
+        "admin_level": app_settings.admin_level,
+        # Boundaries are geocoding results and expire with them
+        "boundary": snapshot_stamp(
+            "boundaries",
+            location_name,
+            ttl=timedelta(days=settings.GEOCODE_TTL_DAYS),
+        ),
+        "districts": snapshot_stamp(
+            "district_catalogues", location_name.partition(", ")[0]
+        ),
+        "sidewalks": snapshot_stamp(
+            "sidewalks", location_name, SIDEWALK_TAGS, app_settings.admin_level
+        ),
+        "benches": snapshot_stamp(
+            "benches", location_name, BENCH_TAGS, app_settings.admin_level
+        ),
+    }
 
 
-def get_map(
+def get_inputs_key(user, location_name):
+    app_settings = AppSettings.objects.get(user=user)
+    return _hash_key(_inputs_fields(app_settings, location_name))
+
+
+def get_analysis_key(
     user,
     location_name,
-    show_benches,
-    show_options,
     good_distance,
     okay_distance,
     simulation,
     budget,
     bench_cost,
 ):
-    budget = float(budget) if budget != "" else None
-    bench_cost = float(bench_cost) if bench_cost != "" else None
+    # Hash of everything the analysis depends on: its parameters, the
+    # content of the uploaded files and the stored OSM snapshots. Colors and
+    # show options only change how the results are drawn and are not part of
+    # it, so changing them in the settings keeps the cached analyses while a
+    # new bench or heatmap file leads to new ones
+    app_settings = AppSettings.objects.get(user=user)
+    fields = _inputs_fields(app_settings, location_name)
+    fields.update(
+        {
+            "good_distance": good_distance,
+            "okay_distance": okay_distance,
+            "simulation": simulation,
+            "budget": budget if simulation else None,
+            "bench_cost": bench_cost if simulation else None,
+            "heatmap_file": _static_file_digest(app_settings.heatmap_file),
+        }
+    )
+    return _hash_key(fields)
+
+
+def _reporter(progress, cancel):
+    def report(percent, stage):
+        # Stop before the next stage once the analysis is cancelled
+        check_cancelled(cancel)
+        if progress is not None:
+            progress(percent, stage)
+
+    return report
+
+
+def _load_inputs(user, location_name, progress=None, cancel=None):
+    report = _reporter(progress, cancel)
 
     # Get settings
     app_settings = AppSettings.objects.get(user=user)
     benches_file = app_settings.benches_file if app_settings.benches_file else None
 
-    # Find location
-    location = geolocator.geocode(location_name)
-
-    # Create Folium map
-    m = folium.Map(
-        location=[location.latitude, location.longitude],
-        zoom_start=15,
-        max_zoom=20,
-        tiles="cartodbpositron",
-        use_container_width=True,
+    # Download the district boundaries, sidewalks and benches at the same time
+    report(10, "Finding district boundaries, sidewalks and benches...")
+    inputs = run_stages(
+        {
+            "district": (
+                get_district_geodataframe,
+                location_name,
+                app_settings.admin_level,
+            ),
+            "sidewalks": (get_sidewalks, location_name, app_settings.admin_level),
+            "benches": (get_osm_benches, location_name, app_settings.admin_level),
+        },
+        cancel=cancel,
     )
+    district = inputs["district"]
+    sidewalks_gdf = inputs["sidewalks"]
 
-    # Get the district boundaries and add to the map
-    district = ox.geocode_to_gdf(location_name)
-    folium.GeoJson(district).add_to(m)
-
-    # Find streets inside the district
-    sidewalks_gdf = get_sidewalks(location_name)
-
-    # Find benches inside the district
-    benches_gdf = get_benches(location_name, district, benches_file)
+    # Add the imported benches inside the district
+    report(40, "Importing benches...")
+    benches_gdf = import_benches(inputs["benches"], district, benches_file)
 
     # Close bench file
     if benches_file is not None:
         benches_file.close()
 
+    # Run the analysis in metres
+    metric_crs = get_metric_crs(district)
+    district = to_crs(district, metric_crs)
+    sidewalks_gdf = to_crs(sidewalks_gdf, metric_crs)
+    benches_gdf = to_crs(benches_gdf, metric_crs)
+
     # Assign benches to sidewalks
+    report(50, "Assigning benches to sidewalks...")
     sidewalks_gdf = assign_benches_to_sidewalks(sidewalks_gdf, benches_gdf)
+    return Inputs(district, sidewalks_gdf, benches_gdf, compute_gap_profiles(sidewalks_gdf))
+
+
+def load_inputs(user, location_name, progress=None, cancel=None):
+    # Inputs of the analysis, cached apart from the results by a key without
+    # the thresholds and the simulation parameters
+    inputs = caches["analysis"].get(f"inputs:{get_inputs_key(user, location_name)}")
+    if inputs is None:
+        inputs = _load_inputs(user, location_name, progress=progress, cancel=cancel)
+        # The key is computed again as the snapshots may have just been stored
+        caches["analysis"].set(f"inputs:{get_inputs_key(user, location_name)}", inputs)
+    return inputs
+
+
+def _run_analysis(
+    user,
+    location_name,
+    good_distance,
+    okay_distance,
+    simulation,
+    budget,
+    bench_cost,
+    progress=None,
+    cancel=None,
+):
+    report = _reporter(progress, cancel)
+
+    budget = float(budget) if budget != "" else None
+    bench_cost = float(bench_cost) if bench_cost != "" else None
+
+    # Get settings
+    app_settings = AppSettings.objects.get(user=user)
+
+    # Sidewalks with their benches and gap profiles
+    district, sidewalks_gdf, benches_gdf, profiles = load_inputs(
+        user, location_name, progress=progress, cancel=cancel
+    )
 
     # Simulate benches
     if simulation:
+        report(60, "Simulating benches...")
         num_benches = calculate_benches(budget, bench_cost)
-        benches_gdf = add_optimized_benches(
-            benches_gdf, sidewalks_gdf, num_benches, good_distance
+        benches_gdf, sidewalks_gdf = add_optimized_benches(
+            benches_gdf, sidewalks_gdf, num_benches, good_distance, profiles
+        )
+        profiles = compute_gap_profiles(sidewalks_gdf)
+
+    # Classify sidewalks from their gap profiles
+    report(70, "Classifying sidewalks...")
+    sidewalks_gdf = classify_sidewalks(
+        sidewalks_gdf.copy(), good_distance, okay_distance, profiles=profiles
+    )
+
+    # Calculate statistics
+    report(80, "Calculating statistics...")
+    street_stats, general_stats = get_basic_statistics(
+        sidewalks_gdf, district, heatmap_file=app_settings.heatmap_file
+    )
+
+    return district, sidewalks_gdf, benches_gdf, street_stats, general_stats
+
+
+def analyse_district(
+    user,
+    location_name,
+    good_distance,
+    okay_distance,
+    simulation,
+    budget,
+    bench_cost,
+    progress=None,
+    cancel=None,
+):
+    # Everything the map shows apart from its styling, in the metric CRS.
+    # `progress(percent, stage)` is called before every stage and setting the
+    # `cancel` event stops the analysis. Results are shared by all users with
+    # the same inputs
+    params = (location_name, good_distance, okay_distance, simulation, budget, bench_cost)
+    analysis = caches["analysis"].get(get_analysis_key(user, *params))
+    if analysis is None:
+        analysis = _run_analysis(user, *params, progress=progress, cancel=cancel)
+        # The key is computed again as the snapshots may have just been stored
+        caches["analysis"].set(get_analysis_key(user, *params), analysis)
+    return analysis
+
+
+def get_map(
+    user,
+    location_name,
+    show_benches,
+    show_options,
+    good_distance,
+    okay_distance,
+    simulation,
+    budget,
+    bench_cost,
+    cancel=None,
+):
+    # Find location while the district is analysed
+    stages = start_stages({"location": (geocode, location_name)})
+    try:
+        district, sidewalks_gdf, benches_gdf, street_stats, general_stats = (
+            analyse_district(
+                user,
+                location_name,
+                good_distance,
+                okay_distance,
+                simulation,
+                budget,
+                bench_cost,
+                cancel=cancel,
+            )
         )
-        sidewalks_gdf = assign_benches_to_sidewalks(sidewalks_gdf, benches_gdf)
+        location = wait_for_stages(stages, cancel=cancel)["location"]
+    finally:
+        stop_stages(stages)
+
+    # Create Folium map
+    m = folium.Map(
+        location=[location.latitude, location.longitude],
+        zoom_start=15,
+        max_zoom=20,
+        tiles="cartodbpositron",
+        use_container_width=True,
+    )
+
+    # Add the district boundaries to the map
+    m = draw_district(m, district)
 
     # Draw benches
     if show_benches:
         m = draw_benches(m, benches_gdf)
 
-    # Classify sidewalks
-    sidewalks_gdf = classify_sidewalks(sidewalks_gdf, good_distance, okay_distance)
-
     # Draw sidewalks
-    colors = {
-        "good_street_color": app_settings.good_color,
-        "okay_street_color": app_settings.okay_color,
-        "bad_street_color": app_settings.bad_color,
-        "one_street_color": app_settings.one_color,
-        "zero_street_color": app_settings.empty_color,
-    }
-
+    colors = get_street_colors(user)
     m = draw_sidewalks(m, sidewalks_gdf, show_options, colors)._repr_html_()
 
-    # Calculate statistics
-    street_stats, general_stats = get_basic_statistics(
-        sidewalks_gdf, district, heatmap_file=app_settings.heatmap_file
-    )
-
     # Add statistics as HTML
     m += "<br><br>"
     m += street_stats.to_html(classes="table table-striped table-hover")
@@ -101,43 +310,67 @@ def get_map(
     return m
 
 
-def get_heatmap(user, location_name):
+def get_street_colors(user):
     app_settings = AppSettings.objects.get(user=user)
+    return {
+        "good_street_color": app_settings.good_color,
+        "okay_street_color": app_settings.okay_color,
+        "bad_street_color": app_settings.bad_color,
+        "one_street_color": app_settings.one_color,
+        "zero_street_color": app_settings.empty_color,
+    }
 
-    location = geolocator.geocode(location_name)
 
-    # read file in the static folder
-    df = pd.read_excel(
-        os.path.join(settings.STATICFILES_DIRS[0], app_settings.heatmap_file.name)
-    )
+def get_map_data(
+    user,
+    location_name,
+    good_distance,
+    okay_distance,
+    simulation,
+    budget,
+    bench_cost,
+    progress=None,
+    cancel=None,
+):
+    if progress is not None:
+        progress(0, "Finding location...")
+    stages = start_stages({"location": (geocode, location_name)})
+    try:
+        district, sidewalks_gdf, benches_gdf, street_stats, general_stats = (
+            analyse_district(
+                user,
+                location_name,
+                good_distance,
+                okay_distance,
+                simulation,
+                budget,
+                bench_cost,
+                progress=progress,
+                cancel=cancel,
+            )
+        )
+        location = wait_for_stages(stages, cancel=cancel)["location"]
+    finally:
+        stop_stages(stages)
+    if progress is not None:
+        progress(90, "Preparing map data...")
+    return {
+        "center": [location.latitude, location.longitude],
+        "district": district_collection(district),
+        "sidewalks": sidewalks_collection(sidewalks_gdf),
+        "benches": bench_rows(benches_gdf),
+        "street_stats": json.loads(street_stats.to_json(orient="split", index=False)),
+        "general_stats": json.loads(general_stats.to_json(orient="split", index=False)),
+    }
 
-    inhabitants = df["LICZBA"].tolist()
-    inhabitants = list(dict.fromkeys(inhabitants))  # delete duplicate values
-    inhabitants.sort()
 
-    # slice 'MultiLineString ((' and ')' from the rows of df['boundaries']
-    df["boundaries"] = df["boundaries"].str.replace(
-        r"^MultiLineString \(\(", "", regex=True
-    )
-    df["boundaries"] = df["boundaries"].str.replace(r"\)\)$", "", regex=True)
-
-    problematic_ids = [
-        2503,
-        2760,
-        3255,
-        3535,
-        3546,
-        3564,
-        3565,
-        3566,
-        3576,
-        3579,
-        3583,
-        3601,
-        3645,
-    ]  # these aint right, just omit them
-
-    df_filtered = df[~df["OBJECTID"].isin(problematic_ids)]
+def get_heatmap(user, location_name, raster=False):
+    app_settings = AppSettings.objects.get(user=user)
+
+    location = geocode(location_name)
+
+    # Compiled heatmap of the file in the static folder
+    path = heatmap_path(app_settings.heatmap_file)
 
     # Create a Folium map centered at Poznań
     m = folium.Map(
@@ -148,33 +381,59 @@ def get_heatmap(user, location_name):
         use_container_width=True,
     )
 
-    for index, row in df_filtered.iterrows():
-        # Split the string into individual coordinate pairs
-        coordinate_pairs = row["boundaries"].split(", ")
-
-        # Calculate the color based on the value of inhabitants
-        color = color_B_to_R(inhabitants, row["LICZBA"])
-
-        # Convert each coordinate pair into a tuple of floats
-        points = [tuple(map(float, pair.split())) for pair in coordinate_pairs]
-
-        # Create a Shapely Polygon from the list of points
-        polygon = Polygon(points)
-
-        # Convert the Polygon to a GeoJSON feature
-        feature = gpd.GeoSeries([polygon]).__geo_interface__
-
-        # Add the GeoJSON feature to the Folium map
-        # Pass the color as a default argument to the lambda function
-        folium.GeoJson(
-            feature,
-            style_function=lambda x, color=color: {
-                "fillColor": color,
-                "color": color,
-                "weight": 2.5,
-                "fillOpacity": 0.3,
-            },
-            tooltip=f"{row['LICZBA']} people",
+    if raster:
+        # Pre-rendered tiles instead of thousands of polygons
+        tiles = reverse(
+            "heatmap_tiles",
+            kwargs={"digest": file_digest(path), "z": 0, "x": 0, "y": 0},
+        ).replace("/0/0/0.png", "/{z}/{x}/{y}.png")
+        folium.TileLayer(
+            tiles=tiles,
+            attr="Population",
+            name="Population",
+            overlay=True,
+            tile_size=TILE_SIZE,
+            max_native_zoom=17,
         ).add_to(m)
+    else:
+        m = draw_heatmap_layer(m, get_heatmap_layer(path))
 
     return m
+
+
+def get_heatmap_layer(path):
+    # The layer only depends on the heatmap file, so it is built once per
+    # file content and shared by all users
+    key = f"heatmap:{ANALYSIS_VERSION}:{file_digest(path)}"
+    layer = caches["analysis"].get(key)
+    if layer is None:
+        df = load_heatmap(path)
+        inhabitants = np.unique(df["LICZBA"])  # sorted distinct values
+        layer = heatmap_layer(df, inhabitants)
+        caches["analysis"].set(key, layer)
+    return layer
+
+
+def get_heatmap_tile(user, digest, z, x, y):
+    app_settings = AppSettings.objects.get(user=user)
+    if not app_settings.heatmap_file:
+        return None
+    return heatmap_tile(heatmap_path(app_settings.heatmap_file), digest, z, x, y)
+
+
+def get_simulation_curve(
+    user, location_name, good_distance, okay_distance, budget, bench_cost
+):
+    # Sidewalks with their benches and gap profiles
+    inputs = load_inputs(user, location_name)
+
+    # Place all benches the budget allows once and record every step
+    num_benches = calculate_benches(budget, bench_cost)
+    return simulate_budget_curve(
+        inputs.sidewalks,
+        num_benches,
+        good_distance,
+        okay_distance,
+        bench_cost=bench_cost,
+        profiles=inputs.profiles,
+    )
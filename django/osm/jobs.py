@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.conf import settings
+from django.db import connections
+from osm.stages import Cancelled
+
+# Analyses run in a pool of worker processes, the requests only submit them
+# and report their progress. Jobs are identified by the hash of their inputs,
+# so duplicate submissions and reloads find the running job or its result.
+# Status and results are files in settings.JOB_DIR, which every process of
+# the server and every worker can read. Clients follow a job by asking for its
+# status. A job is cancelled by creating its cancel file, which only happens on
+# request, as other clients may be following the same job
+
+# A queued or running job without any progress for this long is considered
+# lost (e.g. the server was restarted) and is submitted again
+JOB_TIMEOUT = 15 * 60
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+_submit_lock = threading.Lock()
+
+
+def _status_path(job_id):
+    return os.path.join(settings.JOB_DIR, f"{job_id}.json")
+
+
+def _result_path(job_id):
+    return os.path.join(settings.JOB_DIR, f"{job_id}.result.json")
+
+
+def _cancel_path(job_id):
+    return os.path.join(settings.JOB_DIR, f"{job_id}.cancel")
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _write_json(path, data):
+    # Write to a temporary file first so that readers never see a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def write_status(job_id, status, progress=0, stage="", error=None):
+    _write_json(
+        _status_path(job_id),
+        {
+            "job_id": job_id,
+            "status": status,
+            "progress": progress,
+            "stage": stage,
+            "error": error,
+            "updated": time.time(),
+        },
+    )
+
+
+def read_status(job_id):
+    try:
+        with open(_status_path(job_id), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def read_result(job_id):
+    # The result as JSON text, None until the job is done
+    try:
+        with open(_result_path(job_id), encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class CancelFlag:
+    # Cancel event of a job that works across processes, see osm.stages
+    def __init__(self, job_id):
+        self.path = _cancel_path(job_id)
+
+    def is_set(self):
+        return os.path.exists(self.path)
+
+    def set(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        open(self.path, "w").close()
+
+
+def _init_worker():
+    # Workers are started with "spawn", so Django is set up from scratch. The
+    # database connections must never be shared with the parent process
+    django.setup()
+    connections.close_all()
+
+
+def _run_job(job_id, user_id, params):
+    # Imported here because the models can only be loaded once Django is set up
+    from django.contrib.auth.models import User
+    from osm.interface import get_map_data
+
+    def progress(percent, stage):
+        write_status(job_id, "running", percent, stage)
+
+    try:
+        progress(0, "Starting...")
+        user = User.objects.get(pk=user_id)
+        data = get_map_data(user, progress=progress, cancel=CancelFlag(job_id), **params)
+        _write_json(_result_path(job_id), data)
+        write_status(job_id, "done", 100, "Done")
+    except Cancelled as e:
+        write_status(job_id, "cancelled", error=str(e))
+    except Exception as e:
+        logger.exception("Job %s failed", job_id)
+        write_status(job_id, "failed", error=str(e))
+    finally:
+        _remove(_cancel_path(job_id))
+        connections.close_all()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.JOB_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return _executor
+
+
+def _job_finished(job_id, executor, future):
+    # Jobs catch their own errors, an error here means that the worker died
+    # and the job would stay queued or running
+    global _executor
+    error = future.exception()
+    if error is None:
+        return
+    logger.error("Worker of job %s stopped", job_id, exc_info=error)
+    write_status(job_id, "failed", error="The analysis stopped unexpectedly.")
+    if isinstance(error, BrokenProcessPool):
+        # A broken pool accepts no more jobs, the next submission starts a new one
+        with _executor_lock:
+            if _executor is executor:
+                _executor = None
+
+
+def _is_lost(status):
+    return (
+        status["status"] in ("queued", "running")
+        and time.time() - status["updated"] > JOB_TIMEOUT
+    )
+
+
+def submit_job(job_id, user, params):
+    # Start the job unless it is already queued, running or done. A job about
+    # to be cancelled is kept running for the new client
+    with _submit_lock:
+        _remove(_cancel_path(job_id))
+        status = read_status(job_id)
+        if (
+            status is not None
+            and status["status"] not in ("failed", "cancelled")
+            and not _is_lost(status)
+        ):
+            if status["status"] != "done" or os.path.exists(_result_path(job_id)):
+                return status
+        write_status(job_id, "queued", 0, "Queued...")
+        executor = _get_executor()
+        future = executor.submit(_run_job, job_id, user.pk, params)
+        future.add_done_callback(lambda future: _job_finished(job_id, executor, future))
+        return read_status(job_id)
+
+
+def cancel_job(job_id):
+    # The worker stops the job at its next stage
+    status = read_status(job_id)
+    if status is not None and status["status"] in ("queued", "running"):
+        CancelFlag(job_id).set()
+    return status
+
@@ -0,0 +1,95 @@
+import time
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+# The geocoding and the OSM layers of a district are independent downloads, so
+# they run at the same time in a pool of threads shared by all requests. The
+# analysis waits for all of them, which takes as long as the slowest one.
+# A stage that is not done within settings.STAGE_TIMEOUT seconds of being
+# picked up by a thread fails the analysis, and so does setting the `cancel`
+# event (e.g. when the job is cancelled). Threads cannot be stopped:
+# stages that are already running finish in the background and still fill the
+# caches, the others never start
+
+# How often the waiting request checks the cancel event, in seconds
+POLL_INTERVAL = 0.25
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class StageTimeout(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=settings.STAGE_WORKERS, thread_name_prefix="stage"
+            )
+        return _pool
+
+
+def check_cancelled(cancel):
+    if cancel is not None and cancel.is_set():
+        raise Cancelled("The analysis was cancelled.")
+
+
+def _run_stage(started, name, function, *args):
+    # Time spent waiting for a free thread does not count against the timeout
+    started[name] = time.monotonic()
+    return function(*args)
+
+
+def start_stages(stages):
+    # Submit every stage, given as {name: (function, *args)}, to the pool
+    started = {}
+    pool = _get_pool()
+    return {
+        name: (pool.submit(_run_stage, started, name, function, *args), started)
+        for name, (function, *args) in stages.items()
+    }
+
+
+def wait_for_stages(futures, cancel=None, timeout=None):
+    # Results of the stages started by `start_stages` by their names. The
+    # first error, timeout or cancellation cancels the stages not started yet
+    timeout = settings.STAGE_TIMEOUT if timeout is None else timeout
+    pending = {future: name for name, (future, _) in futures.items()}
+    try:
+        while pending:
+            done, _ = wait(pending, timeout=POLL_INTERVAL, return_when=FIRST_EXCEPTION)
+            for future in done:
+                # Raises the error of a failed stage
+                future.result()
+                del pending[future]
+            check_cancelled(cancel)
+            now = time.monotonic()
+            for future, name in pending.items():
+                started = futures[name][1].get(name)
+                if started is not None and now - started > timeout:
+                    raise StageTimeout(f"Stage '{name}' took longer than {timeout} s.")
+    finally:
+        for future in pending:
+            future.cancel()
+    return {name: future.result() for name, (future, _) in futures.items()}
+
+
+def stop_stages(futures):
+    # Cancel the stages started by `start_stages` that are not running yet
+    # and wait for the others, so that none is left behind when the request
+    # that started them fails
+    running = [future for future, _ in futures.values() if not future.cancel()]
+    wait(running)
+
+
+def run_stages(stages, cancel=None, timeout=None):
+    return wait_for_stages(start_stages(stages), cancel=cancel, timeout=timeout)
@@ -1,19 +1,28 @@
-from geopy.geocoders import Nominatim
-import osmnx as ox
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import Point
+from utils.feature_sources import get_feature_source
+from utils.geocoding import geocode
+from utils.projection import to_crs
+from utils.snapshots import cached_snapshot
 
-geolocator = Nominatim(user_agent="age_friendly")
+SIDEWALK_TAGS = {"highway": ["footway"]}
+BENCH_TAGS = {"amenity": "bench"}
+# Benches closer to a sidewalk than this (in metres) are assigned to it
+BENCH_DISTANCE = 8
+# Shorter sidewalks (in metres) are dropped
+MIN_SIDEWALK_LENGTH = 55
 
 
 def get_location(location_name):
-    return geolocator.geocode(location_name)
+    return geocode(location_name)
 
 
-def get_sidewalks(location_name):
+def fetch_sidewalks(location_name, admin_level=None, source=None):
+    source = source or get_feature_source()
     # Find streets inside the district
-    sidewalks_gdf = ox.features_from_place(location_name, tags={"highway": ["footway"]})
+    sidewalks_gdf = source.features(location_name, SIDEWALK_TAGS, admin_level)
     # Data preprocessing:
     # Remove polygons
     sidewalks_gdf = sidewalks_gdf[sidewalks_gdf.geometry.type != "Polygon"]
@@ -23,18 +32,58 @@ def get_sidewalks(location_name):
     if "footway" in sidewalks_gdf.columns:
         if sidewalks_gdf[sidewalks_gdf["footway"] == "crossing"].shape[0] > 0:
             sidewalks_gdf = sidewalks_gdf[sidewalks_gdf["footway"] != "crossing"]
-    # Calculate the length of each sidewalk
+    # Calculate the length of each sidewalk in metres
+    sidewalks_gdf = sidewalks_gdf.to_crs(sidewalks_gdf.estimate_utm_crs())
     sidewalks_gdf["length"] = sidewalks_gdf.geometry.length
     # Remove short sidewalks from the original GeoDataFrame
-    sidewalks_gdf = sidewalks_gdf[sidewalks_gdf["length"] >= 0.0005]
+    sidewalks_gdf = sidewalks_gdf[sidewalks_gdf["length"] >= MIN_SIDEWALK_LENGTH]
     return sidewalks_gdf
 
 
-def get_benches(location_name, district, benches_file=None):
+def get_sidewalks(location_name, admin_level=None, source=None, refresh=False):
+    # Reuse the stored snapshot of the preprocessed sidewalks while it is fresh
+    return cached_snapshot(
+        "sidewalks",
+        lambda: fetch_sidewalks(location_name, admin_level, source),
+        location_name,
+        tags=SIDEWALK_TAGS,
+        admin_level=admin_level,
+        refresh=refresh,
+    )
+
+
+def fetch_benches(location_name, admin_level=None, source=None):
+    source = source or get_feature_source()
     # Find benches inside the district
-    benches_gdf = ox.features_from_place(location_name, tags={"amenity": "bench"})
+    return source.features(location_name, BENCH_TAGS, admin_level)
+
+
+def get_osm_benches(location_name, admin_level=None, source=None, refresh=False):
+    # OSM benches come from the snapshot store
+    return cached_snapshot(
+        "benches",
+        lambda: fetch_benches(location_name, admin_level, source),
+        location_name,
+        tags=BENCH_TAGS,
+        admin_level=admin_level,
+        refresh=refresh,
+    )
 
-    # Parse benches file
+
+def get_benches(
+    location_name,
+    district,
+    benches_file=None,
+    admin_level=None,
+    source=None,
+    refresh=False,
+):
+    benches_gdf = get_osm_benches(location_name, admin_level, source, refresh)
+    return import_benches(benches_gdf, district, benches_file)
+
+
+def import_benches(benches_gdf, district, benches_file=None):
+    # The imported file is merged on top of the OSM benches
     if benches_file is not None:
         if benches_file.name.endswith(".csv"):
             imported_benches = pd.read_csv(benches_file, sep=";")
@@ -47,6 +96,7 @@ def get_benches(location_name, district, benches_file=None):
             imported_benches["geometry"] = imported_benches.apply(
                 lambda row: Point(row["lon"], row["lat"]), axis=1
             )
+            imported_benches["amenity"] = "import"
             benches_gdf = pd.concat([benches_gdf, imported_benches])
             benches_gdf = benches_gdf[benches_gdf.within(district.geometry[0])]
         else:
@@ -56,14 +106,28 @@ def get_benches(location_name, district, benches_file=None):
     return benches_gdf
 
 
-def assign_benches_to_sidewalks(sidewalks_gdf, benches_gdf):
-    # Buffer sidewalks slightly to include nearby benches
-    buffer_sidewalks = sidewalks_gdf.geometry.buffer(
-        0.00007
-    )  # Adjust buffer size as needed
-    sidewalks_gdf["benches"] = buffer_sidewalks.apply(
-        lambda x: benches_gdf[benches_gdf.within(x)].geometry.tolist()
+def assign_benches_to_sidewalks(sidewalks_gdf, benches_gdf, distance=BENCH_DISTANCE):
+    if sidewalks_gdf.empty:
+        sidewalks_gdf["benches"] = []
+        return sidewalks_gdf
+
+    # Both frames are expected in the metric CRS of the analysis
+    sidewalks = sidewalks_gdf.geometry
+    benches = to_crs(benches_gdf, sidewalks_gdf.crs).geometry
+
+    # Find all (bench, sidewalk) pairs closer than `distance` with the spatial index
+    bench_idx, sidewalk_idx = sidewalks.sindex.query(
+        benches.values, predicate="dwithin", distance=distance
     )
+
+    # Group the benches by sidewalk, keeping the order of the benches table
+    order = np.lexsort((bench_idx, sidewalk_idx))
+    bench_idx, sidewalk_idx = bench_idx[order], sidewalk_idx[order]
+    splits = np.searchsorted(sidewalk_idx, np.arange(1, len(sidewalks_gdf)))
+    bench_geometries = benches.values
+    sidewalks_gdf["benches"] = [
+        list(bench_geometries[idx]) for idx in np.split(bench_idx, splits)
+    ]
     return sidewalks_gdf
 
 
@@ -1,54 +1,134 @@
+from collections import namedtuple
+
 import numpy as np
+import pandas as pd
+import shapely
 
+# Threshold-independent description of where the benches are along every
+# sidewalk: sorted bench positions, gaps between neighbouring benches
+# ("inner"), gaps between the sidewalk ends and the outermost benches ("end"),
+# and the distance at which each sidewalk becomes covered ("critical_distance")
+GapProfiles = namedtuple(
+    "GapProfiles",
+    [
+        "lengths",
+        "counts",
+        "bench_street",
+        "bench_positions",
+        "inner_street",
+        "inner_gaps",
+        "end_street",
+        "end_gaps",
+        "critical_distance",
+    ],
+)
 
-def classify_sidewalks(sidewalks_gdf, good_street_value, okay_street_value):
-    # Function to check if there is a bench every meters along the sidewalk
-    def is_benched_every_x_meters(sidewalk, meters):
-        geometry = sidewalk.geometry
-        benches = sidewalk.benches
-        length = geometry.length
-        num_segments = int(np.ceil(length / meters))
-
-        for i in range(num_segments):
-            try:
-                segment_point = geometry.interpolate(i * meters)
-                close_bench = any(
-                    [segment_point.distance(bench) <= meters for bench in benches]
-                )
-                if not close_bench:
-                    return False
-            except Exception as e:
-                print(e)
-        return True
-
-    # Classify sidewalks
-    sidewalks_gdf["good"] = sidewalks_gdf.apply(
-        lambda x: is_benched_every_x_meters(x, good_street_value), axis=1
-    )
-    sidewalks_gdf["okay"] = sidewalks_gdf.apply(
-        lambda x: is_benched_every_x_meters(x, okay_street_value), axis=1
-    )
-    sidewalks_gdf["bad"] = sidewalks_gdf.apply(
-        lambda x: not is_benched_every_x_meters(x, okay_street_value), axis=1
+
+def compute_gap_profiles(sidewalks_gdf):
+    # Project every bench onto its sidewalk once (linear referencing)
+    lines = np.asarray(sidewalks_gdf.geometry.values)
+    lengths = shapely.length(lines)
+    counts = sidewalks_gdf["benches"].apply(len).to_numpy(dtype=np.intp)
+
+    street_idx = np.repeat(np.arange(len(lines)), counts)
+    benches = np.array(
+        [bench for benches in sidewalks_gdf["benches"] for bench in benches],
+        dtype=object,
     )
+    positions = shapely.line_locate_point(lines[street_idx], shapely.centroid(benches))
 
-    def additional_benches_needed(sidewalk, target_distance):
-        length = sidewalk.geometry.length
-        existing_benches = len(sidewalk.benches)
-        required_benches = int(np.ceil(length / target_distance)) - existing_benches
-        return max(0, required_benches)
+    # Sort by street, then by position along the street
+    order = np.lexsort((positions, street_idx))
+    street_idx, positions = street_idx[order], positions[order]
 
-    sidewalks_gdf["benches_to_okay"] = sidewalks_gdf.apply(
-        lambda x: additional_benches_needed(x, okay_street_value), axis=1
+    same_street = street_idx[1:] == street_idx[:-1]
+    inner_street = street_idx[1:][same_street]
+    inner_gaps = (positions[1:] - positions[:-1])[same_street]
+
+    has_benches = counts > 0
+    last = np.cumsum(counts)[has_benches] - 1
+    first = last - counts[has_benches] + 1
+    end_street = np.concatenate([np.flatnonzero(has_benches)] * 2)
+    end_gaps = np.concatenate(
+        [positions[first], lengths[has_benches] - positions[last]]
     )
-    sidewalks_gdf["benches_to_good"] = sidewalks_gdf.apply(
-        lambda x: additional_benches_needed(x, good_street_value), axis=1
+
+    # A street is covered when benches are at most `distance` apart and the
+    # ends are at most half of it away, streets without benches never are
+    critical_distance = np.full(len(lines), np.inf)
+    critical_distance[has_benches] = 0
+    np.maximum.at(critical_distance, inner_street, inner_gaps)
+    np.maximum.at(critical_distance, end_street, 2 * end_gaps)
+    critical_distance[lengths == 0] = 0
+
+    return GapProfiles(
+        lengths,
+        counts,
+        street_idx,
+        positions,
+        inner_street,
+        inner_gaps,
+        end_street,
+        end_gaps,
+        critical_distance,
     )
 
-    sidewalks_gdf["good"] = sidewalks_gdf["benches_to_good"] == 0
-    sidewalks_gdf["okay"] = (sidewalks_gdf["benches_to_okay"] == 0) & ~sidewalks_gdf[
-        "good"
-    ]
+
+def benches_needed(profiles, distance):
+    # Additional benches so that the street is covered at `distance`, which for
+    # evenly spaced benches is one bench per `distance` metres of street
+    inner_needed = np.maximum(np.ceil(profiles.inner_gaps / distance) - 1, 0)
+    end_needed = np.maximum(np.ceil(profiles.end_gaps / distance - 0.5), 0)
+
+    size = len(profiles.lengths)
+    needed = np.zeros(size)
+    needed += np.bincount(profiles.inner_street, weights=inner_needed, minlength=size)
+    needed += np.bincount(profiles.end_street, weights=end_needed, minlength=size)
+    no_benches = profiles.counts == 0
+    needed[no_benches] = np.ceil(profiles.lengths[no_benches] / distance)
+    return needed.astype(int)
+
+
+def classify_sidewalks(
+    sidewalks_gdf, good_street_value, okay_street_value, profiles=None
+):
+    # Pass precomputed profiles to reclassify without touching the geometries
+    if profiles is None:
+        profiles = compute_gap_profiles(sidewalks_gdf)
+
+    sidewalks_gdf["benches_to_okay"] = benches_needed(profiles, okay_street_value)
+    sidewalks_gdf["benches_to_good"] = benches_needed(profiles, good_street_value)
+
+    sidewalks_gdf["good"] = profiles.critical_distance <= good_street_value
+    sidewalks_gdf["okay"] = (
+        profiles.critical_distance <= okay_street_value
+    ) & ~sidewalks_gdf["good"]
     sidewalks_gdf["bad"] = ~sidewalks_gdf["good"] & ~sidewalks_gdf["okay"]
 
     return sidewalks_gdf
+
+
+def sweep_classification(profiles, good_street_values, okay_street_value):
+    # Share of the street length that is good/okay/bad for every "good"
+    # threshold, keeping the "okay" threshold fixed
+    good_street_values = np.asarray(good_street_values, dtype=float)
+    order = np.argsort(profiles.critical_distance)
+    critical_distance = profiles.critical_distance[order]
+    covered_length = np.concatenate([[0], np.cumsum(profiles.lengths[order])])
+    total_length = covered_length[-1] if covered_length[-1] > 0 else 1
+
+    def covered_share(distances):
+        return covered_length[
+            np.searchsorted(critical_distance, distances, side="right")
+        ] / total_length
+
+    good = covered_share(good_street_values)
+    okay = np.maximum(covered_share(okay_street_value) - good, 0)
+    return pd.DataFrame(
+        {
+            "threshold": good_street_values,
+            "good": good,
+            "okay": okay,
+            "bad": 1 - good - okay,
+        }
+    )
@@ -1,117 +1,274 @@
+import os
+import json
+import base64
 import folium
+import numpy as np
+import pandas as pd
+import shapely
+from django.conf import settings
+from folium.plugins import FastMarkerCluster
+from utils.payload import (
+    DISTRICT_ZOOM,
+    HEATMAP_ZOOM,
+    SIDEWALKS_ZOOM,
+    feature_collection,
+    topology,
+)
+from utils.projection import to_wgs84
+
+
+# Bench icons by kind of bench, embedded in the map as data URLs
+# <a href="https://www.flaticon.com/free-icons/bench" title="bench icons">Bench icons created by Dooder - Flaticon</a>
+BENCH_IMAGES_DIR = os.path.join(settings.STATICFILES_DIRS[0], "images")
+BENCH_ICONS = {
+    "bench": "bench_gray.png",
+    "import": "bench_gray.png",
+    "simulated": "bench.png",
+}
+BENCH_TOOLTIPS = {"import": "Imported bench", "simulated": "Simulated bench"}
+# Imported benches get a blue tint of the OSM bench icon
+BENCH_STYLE = (
+    "<style>.bench-import { filter: sepia(1) saturate(5) hue-rotate(180deg); }</style>"
+)
+
+# Markers are created in the browser from [lat, lon, kind] rows
+BENCH_CALLBACK = """(function () {
+    var urls = %s;
+    var tooltips = %s;
+    var icons = {};
+    for (var kind in urls) {
+        icons[kind] = L.icon({
+            iconUrl: urls[kind],
+            iconSize: [15, 15],
+            className: "bench-" + kind,
+        });
+    }
+    return function (row) {
+        var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icons[row[2]]});
+        if (tooltips[row[2]]) {
+            marker.bindTooltip(tooltips[row[2]]);
+        }
+        return marker;
+    };
+})()"""
+
+
+def _image_data_url(name):
+    with open(os.path.join(BENCH_IMAGES_DIR, name), "rb") as f:
+        return "data:image/png;base64," + base64.b64encode(f.read()).decode()
+
+
+def bench_rows(benches_gdf):
+    # [lat, lon, kind] of every bench: OSM benches, imported benches and
+    # everything else (simulated)
+    benches_gdf = to_wgs84(benches_gdf)
+    amenity = benches_gdf["amenity"].to_numpy()
+    kinds = np.select(
+        [amenity == "bench", amenity == "import"], ["bench", "import"], "simulated"
+    )
+    coords = np.round(
+        shapely.get_coordinates(shapely.centroid(benches_gdf.geometry.values)), 6
+    )
+    return [[lat, lon, kind] for (lon, lat), kind in zip(coords.tolist(), kinds)]
 
 
 def draw_benches(map_object, benches_gdf):
-    for bench in benches_gdf.iterrows():
-        icon = folium.features.CustomIcon(
-            "https://cdn-icons-png.flaticon.com/256/2256/2256995.png",
-            icon_size=(15, 15),
-        )
-        bench_coords = bench[1].geometry.centroid.coords[0]
-        tooltip = "Imported/simulated bench" if bench[1]["amenity"] != "bench" else None
-        folium.Marker(
-            location=[bench_coords[1], bench_coords[0]], icon=icon, tooltip=tooltip
-        ).add_to(map_object)
+    if benches_gdf.empty:
+        return map_object
+    rows = bench_rows(benches_gdf)
+
+    urls = {kind: _image_data_url(name) for kind, name in BENCH_ICONS.items()}
+    map_object.get_root().header.add_child(folium.Element(BENCH_STYLE))
+    FastMarkerCluster(
+        rows,
+        callback=BENCH_CALLBACK % (json.dumps(urls), json.dumps(BENCH_TOOLTIPS)),
+        name="Benches",
+        disableClusteringAtZoom=17,
+        chunkedLoading=True,
+    ).add_to(map_object)
     return map_object
 
 
 def draw_sidewalks(map_object, sidewalks_class, show_options, colors):
-    for index, sidewalk in enumerate(sidewalks_class.iterrows()):
-        # Tooltip text initialization
-        tooltip_text = f"Current Benches: {len(sidewalk[1].benches)} | "
-
-        if sidewalk[1]["good"]:
-            tooltip_text += f"Status: Optimal"
-        elif sidewalk[1]["okay"]:
-            tooltip_text += f"Status: Convenient | "
-        elif sidewalk[1]["bad"]:
-            tooltip_text += f"Status: Insufficient | "
-
-        # Add additional benches needed for okay and good classification
-        if sidewalk[1]["bad"]:
-            tooltip_text += (
-                f"\nBenches to Convenient: {sidewalk[1]['benches_to_okay']} | "
-            )
-        if sidewalk[1]["okay"] or sidewalk[1]["bad"]:
-            tooltip_text += f"\nBenches to Optimal: {sidewalk[1]['benches_to_good']}"
-
-        # Determine the street color and draw the GeoJson
-        if sidewalk[1]["good"] and show_options["good_streets"]:
-            folium.GeoJson(
-                sidewalk[1].geometry,
-                style_function=lambda x: {
-                    "color": colors["good_street_color"],
-                    "weight": 5,
-                    "opacity": 0.8,
-                },
-                tooltip=tooltip_text,
-            ).add_to(map_object)
-        elif sidewalk[1]["okay"] and show_options["okay_streets"]:
-            folium.GeoJson(
-                sidewalk[1].geometry,
-                style_function=lambda x: {
-                    "color": colors["okay_street_color"],
-                    "weight": 5,
-                    "opacity": 0.8,
-                },
-                tooltip=tooltip_text,
-            ).add_to(map_object)
-        elif sidewalk[1]["bad"] and show_options["bad_streets"]:
-            folium.GeoJson(
-                sidewalk[1].geometry,
-                style_function=lambda x: {
-                    "color": colors["bad_street_color"],
-                    "weight": 5,
-                    "opacity": 0.8,
-                },
-                tooltip=tooltip_text,
-            ).add_to(map_object)
-        if (
-            sidewalk[1]["bad"]
-            and len(sidewalk[1].benches) == 1
-            and show_options["one_streets"]
-        ):
-            folium.GeoJson(
-                sidewalk[1].geometry,
-                style_function=lambda x: {
-                    "color": colors["one_street_color"],
-                    "weight": 5,
-                    "opacity": 0.8,
-                },
-                tooltip=tooltip_text,
-            ).add_to(map_object)
-        elif (
-            sidewalk[1]["bad"]
-            and len(sidewalk[1].benches) == 0
-            and show_options["zero_streets"]
-        ):
-            folium.GeoJson(
-                sidewalk[1].geometry,
-                style_function=lambda x: {
-                    "color": colors["zero_street_color"],
-                    "weight": 5,
-                    "opacity": 0.8,
-                },
-                tooltip=tooltip_text,
-            ).add_to(map_object)
+    sidewalks_class = to_wgs84(sidewalks_class)
+    bench_counts = sidewalks_class["benches"].apply(len)
+    counts = bench_counts.to_numpy()
+    good = sidewalks_class["good"].to_numpy(bool)
+    okay = sidewalks_class["okay"].to_numpy(bool)
+    bad = sidewalks_class["bad"].to_numpy(bool)
+
+    # Class shown for every sidewalk: bad streets with one or no benches are
+    # highlighted with their own colors, hidden classes are not drawn
+    street_class = np.select(
+        [
+            good & show_options["good_streets"],
+            okay & show_options["okay_streets"],
+            bad & (counts == 1) & show_options["one_streets"],
+            bad & (counts == 0) & show_options["zero_streets"],
+            bad & show_options["bad_streets"],
+        ],
+        ["good", "okay", "one", "zero", "bad"],
+        default="",
+    )
+    shown = street_class != ""
+
+    # Tooltip text
+    prefix = "Current Benches: " + bench_counts.astype(str) + " | "
+    status = np.select(
+        [good, okay, bad],
+        ["Status: Optimal", "Status: Convenient | ", "Status: Insufficient | "],
+        default="",
+    )
+    to_okay = np.where(
+        bad,
+        "\nBenches to Convenient: "
+        + sidewalks_class["benches_to_okay"].astype(str)
+        + " | ",
+        "",
+    )
+    to_good = np.where(
+        okay | bad,
+        "\nBenches to Optimal: " + sidewalks_class["benches_to_good"].astype(str),
+        "",
+    )
+    tooltip = prefix + status + to_okay + to_good
+
+    features = pd.DataFrame(
+        {
+            "class": street_class,
+            "color": [colors.get(f"{name}_street_color") for name in street_class],
+            "benches": counts,
+            "benches_to_okay": sidewalks_class["benches_to_okay"].to_numpy(),
+            "benches_to_good": sidewalks_class["benches_to_good"].to_numpy(),
+            "tooltip": np.asarray(tooltip),
+        }
+    )[shown]
+    if features.empty:
+        return map_object
+
+    # One GeoJSON layer for all sidewalks, styled by the color of their class
+    folium.GeoJson(
+        feature_collection(
+            sidewalks_class.geometry.values[shown],
+            features.to_dict("records"),
+            SIDEWALKS_ZOOM,
+        ),
+        style_function=lambda feature: {
+            "color": feature["properties"]["color"],
+            "weight": 5,
+            "opacity": 0.8,
+        },
+        tooltip=folium.GeoJsonTooltip(fields=["tooltip"], labels=False),
+    ).add_to(map_object)
 
     return map_object
 
 
-# Calculate the color based on the value of inhabitants
-def color_B_to_R(inhabitants, value):
-    min_ratio = 0
-    max_ratio = (len(inhabitants) - 1) / len(inhabitants)
-    index = inhabitants.index(value)
+def sidewalks_collection(sidewalks_class):
+    # Classified sidewalks without any styling, for clients that color and
+    # filter them themselves
+    sidewalks_class = to_wgs84(sidewalks_class)
+    status = np.select(
+        [sidewalks_class["good"].to_numpy(bool), sidewalks_class["okay"].to_numpy(bool)],
+        ["good", "okay"],
+        default="bad",
+    )
+    properties = pd.DataFrame(
+        {
+            "status": status,
+            "benches": sidewalks_class["benches"].apply(len).to_numpy(),
+            "benches_to_okay": sidewalks_class["benches_to_okay"].to_numpy(),
+            "benches_to_good": sidewalks_class["benches_to_good"].to_numpy(),
+        }
+    ).to_dict("records")
+    return feature_collection(sidewalks_class.geometry.values, properties, SIDEWALKS_ZOOM)
+
+
+def district_collection(district_gdf):
+    district_gdf = to_wgs84(district_gdf)
+    return feature_collection(
+        district_gdf.geometry.values, [{}] * len(district_gdf), DISTRICT_ZOOM
+    )
+
+
+# Two-digit hex codes of all color channel values
+HEX_CODES = np.array([f"{value:02X}" for value in range(256)], dtype=object)
 
-    # calculate the ratio based on the index
-    ratio = index / len(inhabitants)
+
+def inhabitants_ratio(inhabitants, values):
+    # Rank of every value among the sorted distinct values of inhabitants
+    return np.searchsorted(np.asarray(inhabitants), values) / len(inhabitants)
+
+
+# Calculate the colors based on the values of inhabitants
+def color_B_to_R(inhabitants, values):
+    ratio = inhabitants_ratio(inhabitants, values)
 
     # interpolate between blue and red based on the ratio
-    red_value = int((1 - ratio) * 255)  # More red when ratio is close to 0
-    blue_value = int(ratio * 255)  # More blue when ratio is close to 1
+    red_values = ((1 - ratio) * 255).astype(int)  # More red when ratio is close to 0
+    blue_values = (ratio * 255).astype(int)  # More blue when ratio is close to 1
+
+    # create colors in RGB format
+    return "#" + HEX_CODES[blue_values] + "00" + HEX_CODES[red_values]
+
+
+def draw_district(map_object, district_gdf):
+    folium.GeoJson(district_collection(district_gdf)).add_to(map_object)
+    return map_object
+
+
+def heatmap_layer(heatmap_gdf, inhabitants, topojson=True):
+    # TopoJSON (or GeoJSON) of the blocks with the color and the tooltip of
+    # every block as properties of its feature, None without any blocks
+    if heatmap_gdf.empty:
+        return None
+    heatmap_gdf = to_wgs84(heatmap_gdf)
+    values = heatmap_gdf["LICZBA"].to_numpy()
+    colors = color_B_to_R(inhabitants, values)
+    properties = [
+        {"color": color, "tooltip": f"{value} people"}
+        for color, value in zip(colors, values)
+    ]
+    if topojson:
+        # Boundaries shared by neighbouring blocks are sent only once
+        return topology(heatmap_gdf.geometry.values, properties, HEATMAP_ZOOM)
+    return feature_collection(heatmap_gdf.geometry.values, properties, HEATMAP_ZOOM)
+
+
+def draw_heatmap_layer(map_object, layer, opacity=0.3, weight=2.5):
+    # One layer for all blocks from `heatmap_layer`, which only depends on the
+    # heatmap and can be built once
+    if layer is None:
+        return map_object
+
+    def style_function(feature):
+        return {
+            "fillColor": feature["properties"]["color"],
+            "color": feature["properties"]["color"],
+            "weight": weight,
+            "fillOpacity": opacity,
+        }
+
+    tooltip = folium.GeoJsonTooltip(fields=["tooltip"], labels=False)
+    if layer["type"] == "Topology":
+        folium.TopoJson(
+            layer,
+            "objects.features",
+            style_function=style_function,
+            tooltip=tooltip,
+        ).add_to(map_object)
+    else:
+        folium.GeoJson(
+            layer,
+            style_function=style_function,
+            tooltip=tooltip,
+        ).add_to(map_object)
+    return map_object
 
-    # create a color in RGB format
-    color = f"#{blue_value:02X}00{red_value:02X}"
 
-    return color
+def draw_heatmap(
+    map_object, heatmap_gdf, inhabitants, opacity=0.3, weight=2.5, topojson=True
+):
+    return draw_heatmap_layer(
+        map_object, heatmap_layer(heatmap_gdf, inhabitants, topojson), opacity, weight
+    )
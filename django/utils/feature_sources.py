@@ -0,0 +1,85 @@
+import os
+import osmnx as ox
+from django.conf import settings
+from utils.districts import get_district_geodataframe
+
+
+class FeatureSource:
+    # Interface for everything that can deliver OSM features for a place.
+    # `admin_level` is the level a district was picked from
+    def features(self, location_name, tags, admin_level=None):
+        raise NotImplementedError
+
+
+def _boundary(location_name, admin_level=None):
+    # The same boundary as the analysis, from the district catalogue or the
+    # shared geocoding cache
+    return get_district_geodataframe(location_name, admin_level).geometry.iloc[0]
+
+
+class OverpassFeatureSource(FeatureSource):
+    # Live source: every call is an Overpass API round-trip
+    def features(self, location_name, tags, admin_level=None):
+        return ox.features_from_polygon(_boundary(location_name, admin_level), tags=tags)
+
+
+class ExtractFeatureSource(FeatureSource):
+    # Local source: features are read from an .osm/.osm.pbf extract of the city
+    # once per tag set and then clipped to the requested district
+    def __init__(self, path):
+        self.path = path
+        self._layers = {}
+
+    def features(self, location_name, tags, admin_level=None):
+        layer = self._load(tags)
+        polygon = _boundary(location_name, admin_level)
+        # The spatial index finds the candidates and runs the exact test on them
+        candidates = layer.sindex.query(polygon, predicate="intersects")
+        return layer.iloc[sorted(candidates)]
+
+    def _load(self, tags):
+        key = tuple(sorted((tag, str(value)) for tag, value in tags.items()))
+        if key not in self._layers:
+            if self.path.endswith(".pbf"):
+                self._layers[key] = self._read_pbf(tags)
+            else:
+                self._layers[key] = ox.features_from_xml(self.path, tags=tags)
+        return self._layers[key]
+
+    def _read_pbf(self, tags):
+        try:
+            from pyrosm import OSM
+        except ImportError:
+            raise ImportError(
+                "Reading .osm.pbf extracts requires `pyrosm`. Install it or use an .osm extract."
+            )
+        # pyrosm expects a list of values (or True) for every tag
+        custom_filter = {
+            tag: [value] if isinstance(value, str) else value
+            for tag, value in tags.items()
+        }
+        features_gdf = OSM(self.path).get_data_by_custom_criteria(
+            custom_filter=custom_filter,
+            filter_type="keep",
+            keep_nodes=True,
+            keep_ways=True,
+            keep_relations=True,
+        )
+        # Use the same index as osmnx so the rest of the pipeline is unaffected
+        features_gdf = features_gdf.rename(
+            columns={"osm_type": "element_type", "id": "osmid"}
+        )
+        return features_gdf.set_index(["element_type", "osmid"])
+
+
+_extract_sources = {}
+
+
+def get_feature_source():
+    # Use the local extract if one is configured, otherwise query Overpass
+    path = getattr(settings, "OSM_EXTRACT_PATH", None)
+    if not path or not os.path.exists(path):
+        return OverpassFeatureSource()
+    if path not in _extract_sources:
+        _extract_sources[path] = ExtractFeatureSource(str(path))
+    return _extract_sources[path]
@@ -0,0 +1,143 @@
+import os
+import shutil
+import hashlib
+import threading
+
+import pandas as pd
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import box
+from django.conf import settings
+
+# Bump when the compilation changes so that old artifacts are not reused
+HEATMAP_VERSION = 2
+
+# In-process copies of the compiled heatmaps, by content hash
+_heatmaps = {}
+# Content hashes of the heatmap files, by (path, mtime, size)
+_digests = {}
+_lock = threading.Lock()
+
+
+def heatmap_path(heatmap_file):
+    return os.path.join(settings.STATICFILES_DIRS[0], heatmap_file.name)
+
+
+def file_digest(path):
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in _digests:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        _digests[key] = digest.hexdigest()[:32]
+    return _digests[key]
+
+
+def _artifact_path(digest):
+    return os.path.join(settings.HEATMAP_CACHE_DIR, f"{digest}-v{HEATMAP_VERSION}.parquet")
+
+
+def _repair_boundary(wkt):
+    # Fallback for boundaries the bulk parser can't turn into polygons
+    if not isinstance(wkt, str):
+        return None
+    lines = shapely.from_wkt(wkt, on_invalid="ignore")
+    if lines is None:
+        # Excel cuts cells at 32767 characters, drop the partial last coordinate
+        lines = shapely.from_wkt(wkt[: wkt.rfind(",")] + "))", on_invalid="ignore")
+        if lines is None:
+            return None
+    # Close open rings
+    try:
+        rings = [
+            shapely.linearrings(shapely.get_coordinates(part))
+            for part in shapely.get_parts(lines)
+        ]
+    except (ValueError, shapely.errors.GEOSException):
+        return None
+    polygon = shapely.build_area(shapely.multilinestrings(rings))
+    if polygon.is_empty:
+        # Closing a truncated ring can make it self-intersecting, which
+        # build_area can't polygonize, the validity pass fixes it instead
+        polygon = shapely.polygons(rings[0], holes=rings[1:] or None)
+    return polygon
+
+
+def compile_heatmap(path):
+    # Parse the workbook into polygons with the number of inhabitants
+    df = pd.read_excel(path)
+
+    # Ensure the workbook has the correct columns
+    if not {"OBJECTID", "LICZBA", "boundaries"}.issubset(df.columns):
+        raise KeyError(
+            "The heatmap file is missing required columns: 'OBJECTID', 'LICZBA', 'boundaries'."
+        )
+
+    # The boundaries are MultiLineString WKT with one closed ring per part,
+    # inner rings become holes
+    wkt = df["boundaries"].to_numpy(dtype=object)
+    polygons = shapely.build_area(shapely.from_wkt(wkt, on_invalid="ignore"))
+
+    needs_repair = np.flatnonzero(shapely.is_missing(polygons) | shapely.is_empty(polygons))
+    for i in needs_repair:
+        polygons[i] = _repair_boundary(wkt[i])
+
+    invalid = np.flatnonzero(~shapely.is_valid(polygons) & ~shapely.is_missing(polygons))
+    polygons[invalid] = shapely.make_valid(polygons[invalid])
+
+    polygonal = np.isin(shapely.get_type_id(polygons), [3, 6]) & ~shapely.is_empty(polygons)
+    dropped = df["OBJECTID"][~polygonal].tolist()
+    if len(needs_repair) or len(invalid) or dropped:
+        print(
+            f"Heatmap: repaired {polygonal[needs_repair].sum()} boundaries, "
+            f"fixed {len(invalid)} invalid polygons, dropped OBJECTID {dropped}"
+        )
+
+    gdf = gpd.GeoDataFrame(
+        df[["OBJECTID", "LICZBA"]], geometry=polygons, crs="EPSG:4326"
+    )
+    return gdf[polygonal].reset_index(drop=True)
+
+
+def load_heatmap(path, bbox=None):
+    # Compile the workbook on first use, later calls read the GeoParquet
+    # artifact (or the in-process copy) instead of the workbook
+    digest = file_digest(path)
+    with _lock:
+        if digest not in _heatmaps:
+            artifact = _artifact_path(digest)
+            if os.path.exists(artifact):
+                gdf = gpd.read_parquet(artifact)
+            else:
+                gdf = compile_heatmap(path)
+                os.makedirs(os.path.dirname(artifact), exist_ok=True)
+                tmp_path = f"{artifact}.{os.getpid()}.tmp"
+                gdf.to_parquet(tmp_path, write_covering_bbox=True)
+                os.replace(tmp_path, artifact)
+            _heatmaps[digest] = gdf
+        gdf = _heatmaps[digest]
+
+    if bbox is None:
+        return gdf
+    # Preselect the polygons intersecting the bbox (WGS84) with the spatial index
+    return gdf.iloc[sorted(gdf.sindex.query(box(*bbox), predicate="intersects"))]
+
+
+def discard_heatmap(heatmap_file):
+    # Remove the artifact of a heatmap file that is replaced or deleted
+    if not heatmap_file:
+        return
+    path = heatmap_path(heatmap_file)
+    if not os.path.exists(path):
+        return
+    digest = file_digest(path)
+    with _lock:
+        _heatmaps.pop(digest, None)
+    artifact = _artifact_path(digest)
+    if os.path.exists(artifact):
+        os.remove(artifact)
+    tiles = os.path.join(settings.HEATMAP_CACHE_DIR, "tiles", digest)
+    shutil.rmtree(tiles, ignore_errors=True)
@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import shapely
+from django.conf import settings
+from folium.utilities import write_png
+from utils.drawing import inhabitants_ratio
+from utils.heatmap_data import file_digest, load_heatmap
+
+TILE_SIZE = 256
+# Opacity of the blocks (0-255), the same as the fill of the vector heatmap
+TILE_ALPHA = 77
+
+
+def _tile_path(digest, z, x, y):
+    return os.path.join(
+        settings.HEATMAP_CACHE_DIR, "tiles", digest, str(z), str(x), f"{y}.png"
+    )
+
+
+def _pixel_centers(z, x, y, size=TILE_SIZE):
+    # Longitudes and latitudes of the pixel centers of an XYZ (Web Mercator)
+    # tile, the first row is the northern edge
+    n = 2**z
+    lons = (x + (np.arange(size) + 0.5) / size) / n * 360 - 180
+    rows = (y + (np.arange(size) + 0.5) / size) / n
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * rows))))
+    return np.meshgrid(lons, lats)
+
+
+def rasterize(heatmap_gdf, inhabitants, lons, lats):
+    # RGBA image with the color of the block containing every pixel center,
+    # the point-in-polygon tests run in bulk on the spatial index
+    image = np.zeros(lons.shape + (4,), dtype=np.uint8)
+    west, south, east, north = heatmap_gdf.total_bounds
+    if (
+        lons.max() < west
+        or lons.min() > east
+        or lats.max() < south
+        or lats.min() > north
+    ):
+        return image
+
+    points = shapely.points(lons.ravel(), lats.ravel())
+    point_idx, block_idx = heatmap_gdf.sindex.query(points, predicate="within")
+    ratio = inhabitants_ratio(inhabitants, heatmap_gdf["LICZBA"].to_numpy()[block_idx])
+
+    # Same colors as color_B_to_R
+    pixels = image.reshape(-1, 4)
+    pixels[point_idx, 0] = (ratio * 255).astype(int)
+    pixels[point_idx, 2] = ((1 - ratio) * 255).astype(int)
+    pixels[point_idx, 3] = TILE_ALPHA
+    return image
+
+
+def heatmap_tile(path, digest, z, x, y):
+    # PNG of one tile, rendered once per heatmap file and kept on disk
+    if digest != file_digest(path):
+        return None
+    tile_path = _tile_path(digest, z, x, y)
+    if not os.path.exists(tile_path):
+        heatmap_gdf = load_heatmap(path)
+        lons, lats = _pixel_centers(z, x, y)
+        png = write_png(
+            rasterize(heatmap_gdf, np.unique(heatmap_gdf["LICZBA"]), lons, lats)
+        )
+        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+        tmp_path = f"{tile_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(png)
+        os.replace(tmp_path, tile_path)
+    with open(tile_path, "rb") as f:
+        return f.read()
@@ -0,0 +1,19 @@
+# The analysis runs in metres in the UTM zone of the district. Frames are
+# projected once when they enter the pipeline and converted back to WGS84
+# only for drawing.
+
+
+def get_metric_crs(district):
+    # UTM zone containing the district centroid
+    return district.estimate_utm_crs()
+
+
+def to_crs(gdf, crs):
+    # Skip the reprojection when the frame already is in the target CRS
+    if gdf.crs is not None and gdf.crs.equals(crs):
+        return gdf
+    return gdf.to_crs(crs)
+
+
+def to_wgs84(gdf):
+    return to_crs(gdf, "EPSG:4326")
@@ -1,97 +1,217 @@
+import heapq
 import geopandas as gpd
 import numpy as np
 import pandas as pd
-from shapely.geometry import LineString, MultiPoint, Point
-
-
-def add_simulated_benches(benches_gdf, sidewalks_gdf, longest_bad_streets, num_benches):
-    benches_to_add = []
-    for _, street in longest_bad_streets.iterrows():
-        # Calculate the position to place the bench (in the middle of the street)
-        bench_point = street.geometry.interpolate(0.5, normalized=True)
-        bench = gpd.GeoDataFrame(
-            index=[0], crs=sidewalks_gdf.crs, geometry=[bench_point]
-        )
-
-        # Collect the bench in a list
-        benches_to_add.append(bench)
-
-    # Concatenate the new benches to the existing benches GeoDataFrame
-    if benches_to_add:
-        benches_gdf = pd.concat([benches_gdf] + benches_to_add, ignore_index=True)
-
-    return benches_gdf
-
-
-def add_optimized_benches(benches_gdf, sidewalks_gdf, num_benches, good_street_value):
-    # Function to find the optimal bench placement point on a street
-    def find_optimal_bench_placement(street):
-        # Split the street into segments between existing benches
-        segments = split_street_by_benches(street["geometry"], street["benches"])
-
-        # Find the longest segment
-        longest_segment = max(segments, key=lambda seg: seg.length)
-
-        # Place the bench at the midpoint of the longest segment
-        bench_point = longest_segment.interpolate(0.5, normalized=True)
-        return gpd.GeoDataFrame(
-            index=[0], crs=sidewalks_gdf.crs, geometry=[bench_point]
-        )
-
-    def split_street_by_benches(street_geometry, benches):
-        # Ensure that the geometry is LineString and get boundary points
-        if isinstance(street_geometry, LineString):
-            coords = list(street_geometry.coords)
-            start_point = Point(coords[0])
-            end_point = Point(coords[-1])
-
-            # Ensure benches are in a list of Point objects
-            bench_points = []
-            if isinstance(benches, MultiPoint):
-                bench_points = list(benches.geoms)
-            elif isinstance(benches, Point):
-                bench_points = [benches]
-            elif isinstance(benches, list):
-                bench_points = [b for b in benches if isinstance(b, Point)]
-
-            # Combine and sort points along the street geometry
-            all_points = [start_point] + bench_points + [end_point]
-            all_points.sort(key=lambda point: street_geometry.project(point))
-
-            # Create segments between each pair of points
-            return [
-                LineString([all_points[i], all_points[i + 1]])
-                for i in range(len(all_points) - 1)
-            ]
+import shapely
+from utils.classification import benches_needed, compute_gap_profiles
+
+
+# Kinds of gaps along a sidewalk: between two benches, between the start of
+# the sidewalk and the first bench, between the last bench and the end, and
+# a sidewalk without any benches
+INNER, START, END, EMPTY = range(4)
+
+
+def _gap_priority(kind, start, end):
+    # Distance from the worst placed point of the gap to the nearest bench
+    if kind == INNER:
+        return (end - start) / 2
+    return end - start
+
+
+def _gap_is_covered(kind, start, end, distance):
+    if kind == INNER:
+        return end - start <= distance
+    if kind == EMPTY:
+        return end <= start
+    return end - start <= distance / 2
+
+
+def _split_gap(kind, start, end):
+    # Position of the new bench and the gaps it leaves behind
+    if kind == INNER:
+        position = (start + end) / 2
+        return position, [(INNER, start, position), (INNER, position, end)]
+    if kind == START:
+        position = start + (end - start) / 3
+        return position, [(START, start, position), (INNER, position, end)]
+    if kind == END:
+        position = end - (end - start) / 3
+        return position, [(INNER, start, position), (END, position, end)]
+    position = (start + end) / 2
+    return position, [(START, start, position), (END, position, end)]
+
+
+def _initial_gaps(profiles):
+    gaps = []
+    street, positions = profiles.bench_street, profiles.bench_positions
+    for i in range(len(positions)):
+        is_first = i == 0 or street[i - 1] != street[i]
+        is_last = i == len(positions) - 1 or street[i + 1] != street[i]
+        if is_first:
+            gaps.append((street[i], START, 0.0, positions[i]))
+        if is_last:
+            gaps.append((street[i], END, positions[i], profiles.lengths[street[i]]))
         else:
-            # If street_geometry is not a LineString, return an empty list
-            return []
-
-    # Identify streets that need benches
-    sidewalks_gdf["benches_needed_for_okay"] = sidewalks_gdf.apply(
-        lambda x: max(
-            0, int(np.ceil(x["length"] / good_street_value)) - len(x["benches"])
-        ),
-        axis=1,
-    )
-    streets_needing_benches = sidewalks_gdf[sidewalks_gdf.benches_needed_for_okay > 0]
-
-    # Sort these streets by the number of benches needed
-    prioritized_streets = streets_needing_benches.sort_values(
-        "benches_needed_for_okay", ascending=False
-    )
-
-    # Add benches to the streets with the highest priority first
-    benches_to_add = []
-    for _, street in prioritized_streets.iterrows():
-        if num_benches <= 0:
+            gaps.append((street[i], INNER, positions[i], positions[i + 1]))
+    for i in np.flatnonzero(profiles.counts == 0):
+        gaps.append((i, EMPTY, 0.0, profiles.lengths[i]))
+    return gaps
+
+
+def greedy_placements(profiles, good_street_value):
+    # Greedily place benches in the gap that is furthest from any bench. Every
+    # gap is independent of the others, so after a placement only the two new
+    # gaps are pushed onto the heap. Yields (street, position, old gap, new gaps)
+    heap = [
+        (-_gap_priority(kind, start, end), street, kind, start, end)
+        for street, kind, start, end in _initial_gaps(profiles)
+    ]
+    heapq.heapify(heap)
+    while heap:
+        _, street, kind, start, end = heapq.heappop(heap)
+        # Gaps that are already short enough don't need a bench
+        if _gap_is_covered(kind, start, end, good_street_value):
+            continue
+        position, new_gaps = _split_gap(kind, start, end)
+        for gap in new_gaps:
+            heapq.heappush(heap, (-_gap_priority(*gap), street, *gap))
+        yield street, position, (kind, start, end), new_gaps
+
+
+def add_optimized_benches(
+    benches_gdf, sidewalks_gdf, num_benches, good_street_value, profiles=None
+):
+    # Benches with the simulated ones and the sidewalks with every simulated
+    # bench added to the street it was placed on only, as in
+    # simulate_budget_curve, so that the map matches the end of the curve
+    if profiles is None:
+        profiles = compute_gap_profiles(sidewalks_gdf)
+
+    placements = []
+    for placement in greedy_placements(profiles, good_street_value):
+        if len(placements) >= num_benches:
+            break
+        placements.append(placement[:2])
+
+    # Convert the positions along the sidewalks to points
+    sidewalks_gdf = sidewalks_gdf.copy()
+    if placements:
+        streets, positions = np.array(placements).T
+        streets = streets.astype(int)
+        lines = np.asarray(sidewalks_gdf.geometry.values)[streets]
+        points = shapely.line_interpolate_point(lines, positions)
+        new_benches_gdf = gpd.GeoDataFrame(
+            {"amenity": "simulated"},
+            index=range(len(placements)),
+            geometry=points,
+            crs=sidewalks_gdf.crs,
+        )
+        benches_gdf = pd.concat([benches_gdf, new_benches_gdf], ignore_index=True)
+
+        # New lists, the benches of the given sidewalks stay as they are
+        placed = pd.Series(list(points)).groupby(streets).agg(list)
+        sidewalks_gdf["benches"] = [
+            benches + placed.get(i, [])
+            for i, benches in enumerate(sidewalks_gdf["benches"])
+        ]
+
+    return benches_gdf, sidewalks_gdf
+
+
+def _gap_benches_needed(kind, start, end, distance):
+    # Same rules as benches_needed in utils.classification, for a single gap
+    if kind == INNER:
+        return max(int(np.ceil((end - start) / distance)) - 1, 0)
+    if kind == EMPTY:
+        return int(np.ceil((end - start) / distance))
+    return max(int(np.ceil((end - start) / distance - 0.5)), 0)
+
+
+def simulate_budget_curve(
+    sidewalks_gdf,
+    num_benches,
+    good_street_value,
+    okay_street_value,
+    bench_cost=None,
+    profiles=None,
+):
+    # Run the greedy placement once and record the statistics after every
+    # placed bench, so that the whole friendliness-vs-budget curve is known
+    if profiles is None:
+        profiles = compute_gap_profiles(sidewalks_gdf)
+    # Streets are weighted by the same lengths as in get_basic_statistics
+    lengths = sidewalks_gdf["length"].to_numpy(dtype=float)
+    total_length = lengths.sum() if lengths.sum() > 0 else 1
+
+    counts = profiles.counts.astype(float)
+    to_good = benches_needed(profiles, good_street_value).astype(float)
+    to_okay = benches_needed(profiles, okay_street_value).astype(float)
+
+    def friendliness(street):
+        benches = counts[street] + to_good[street]
+        return counts[street] / benches if benches > 0 else 0
+
+    def street_class(street):
+        if to_good[street] == 0:
+            return "good"
+        return "okay" if to_okay[street] == 0 else "bad"
+
+    # Length-weighted friendliness (as in get_basic_statistics) and class lengths
+    score = sum(friendliness(i) * lengths[i] for i in range(len(lengths)))
+    class_lengths = {"good": 0.0, "okay": 0.0, "bad": 0.0}
+    for i in range(len(lengths)):
+        class_lengths[street_class(i)] += lengths[i]
+
+    def record(benches, street=None, position=None):
+        return {
+            "benches": benches,
+            "cost": benches * bench_cost if bench_cost else None,
+            "friendliness": score / total_length * 100,
+            "good_length_km": class_lengths["good"] / 1000,
+            "okay_length_km": class_lengths["okay"] / 1000,
+            "bad_length_km": class_lengths["bad"] / 1000,
+            "street": street,
+            "position": position,
+        }
+
+    rows = [record(0)]
+    for street, position, old_gap, new_gaps in greedy_placements(
+        profiles, good_street_value
+    ):
+        if len(rows) > num_benches:
             break
-        bench = find_optimal_bench_placement(street)
-        benches_to_add.append(bench)
-        num_benches -= 1
-
-    # Concatenate the new benches to the existing benches GeoDataFrame
-    if benches_to_add:
-        benches_gdf = pd.concat([benches_gdf] + benches_to_add, ignore_index=True)
 
-    return benches_gdf
+        # Only the touched street changes
+        score -= friendliness(street) * lengths[street]
+        class_lengths[street_class(street)] -= lengths[street]
+        counts[street] += 1
+        for distance, needed in [
+            (good_street_value, to_good),
+            (okay_street_value, to_okay),
+        ]:
+            needed[street] += sum(
+                _gap_benches_needed(*gap, distance) for gap in new_gaps
+            ) - _gap_benches_needed(*old_gap, distance)
+        score += friendliness(street) * lengths[street]
+        class_lengths[street_class(street)] += lengths[street]
+
+        rows.append(record(len(rows), street, position))
+
+    curve = pd.DataFrame(rows)
+
+    # Placement order as coordinates of the new benches
+    placed = curve["street"].notna()
+    lines = np.asarray(sidewalks_gdf.geometry.values)[
+        curve.loc[placed, "street"].astype(int)
+    ]
+    points = gpd.GeoSeries(
+        shapely.line_interpolate_point(lines, curve.loc[placed, "position"].to_numpy(float)),
+        crs=sidewalks_gdf.crs,
+    ).to_crs(epsg=4326)
+    curve.loc[placed, "longitude"] = points.x.to_numpy()
+    curve.loc[placed, "latitude"] = points.y.to_numpy()
+    curve["street"] = curve["street"].map(
+        lambda i: None if pd.isna(i) else str(sidewalks_gdf.index[int(i)])
+    )
+    return curve.drop(columns="position")
@@ -0,0 +1,122 @@
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime, timedelta
+
+import pandas as pd
+import geopandas as gpd
+import pyarrow.parquet as pq
+from django.conf import settings
+
+# Bump when the preprocessing changes so that old snapshots are not reused
+SNAPSHOT_VERSION = 2
+# Number of dated snapshots kept per key
+SNAPSHOT_HISTORY = 3
+
+
+def snapshot_key(place, tags=None, admin_level=None):
+    key = json.dumps(
+        {
+            "version": SNAPSHOT_VERSION,
+            "place": place,
+            "tags": tags,
+            "admin_level": admin_level,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+def _snapshot_dir(kind, key):
+    return os.path.join(settings.SNAPSHOT_DIR, kind, key)
+
+
+def _snapshot_files(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(f for f in os.listdir(directory) if f.endswith(".parquet"))
+
+
+def _scalar_or_str(value):
+    if value is None or isinstance(value, str):
+        return value
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return value
+    return str(value)
+
+
+def _parquet_safe(df):
+    # OSM tag columns mix strings, numbers and lists, which parquet can't store
+    df = df.copy()
+    geometry = df.geometry.name if isinstance(df, gpd.GeoDataFrame) else None
+    for column in df.columns:
+        if column != geometry and df[column].dtype == object:
+            df[column] = df[column].map(_scalar_or_str)
+    return df
+
+
+def _is_expired(path, ttl=None):
+    ttl = ttl if ttl is not None else timedelta(days=settings.SNAPSHOT_TTL_DAYS)
+    return datetime.now() - datetime.fromtimestamp(os.path.getmtime(path)) > ttl
+
+
+def load_snapshot(kind, place, tags=None, admin_level=None, ttl=None, snapshot_date=None):
+    directory = _snapshot_dir(kind, snapshot_key(place, tags, admin_level))
+    files = _snapshot_files(directory)
+    if snapshot_date is not None:
+        name = f"{snapshot_date:%Y-%m-%d}.parquet"
+        files = [name] if name in files else []
+    if not files:
+        return None
+
+    path = os.path.join(directory, files[-1])
+    # Refresh snapshots that are older than the TTL (explicit dates never expire)
+    if snapshot_date is None and _is_expired(path, ttl):
+        return None
+
+    metadata = pq.read_schema(path).metadata or {}
+    if b"geo" in metadata:
+        return gpd.read_parquet(path)
+    return pd.read_parquet(path)
+
+
+def snapshot_stamp(kind, place, tags=None, admin_level=None, ttl=None):
+    # Identifies the newest stored snapshot, changes whenever it is refreshed.
+    # None if there is none or it has expired, as it is fetched again then
+    directory = _snapshot_dir(kind, snapshot_key(place, tags, admin_level))
+    files = _snapshot_files(directory)
+    if not files:
+        return None
+    path = os.path.join(directory, files[-1])
+    if _is_expired(path, ttl):
+        return None
+    return f"{files[-1]}:{os.stat(path).st_mtime_ns}"
+
+
+def save_snapshot(kind, df, place, tags=None, admin_level=None):
+    directory = _snapshot_dir(kind, snapshot_key(place, tags, admin_level))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{datetime.now():%Y-%m-%d}.parquet")
+
+    # Write to a temporary file first so that readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    _parquet_safe(df).to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+    # Drop the oldest snapshots
+    for old in _snapshot_files(directory)[:-SNAPSHOT_HISTORY]:
+        os.remove(os.path.join(directory, old))
+    return path
+
+
+def cached_snapshot(kind, fetch, place, tags=None, admin_level=None, refresh=False, ttl=None):
+    # Return the stored snapshot, or fetch, store and return a fresh one
+    if not refresh:
+        df = load_snapshot(kind, place, tags, admin_level, ttl=ttl)
+        if df is not None:
+            return df
+    df = fetch()
+    save_snapshot(kind, df, place, tags, admin_level)
+    return df
@@ -3,7 +3,8 @@ import numpy as np
 import geopandas as gpd
 import os
 from django.conf import settings
-from shapely.geometry import MultiLineString, LineString
+from utils.heatmap_data import heatmap_path, load_heatmap
+from utils.projection import to_wgs84
 
 
 def calculate_single_street_friendliness(sidewalk):
@@ -15,53 +16,17 @@ def calculate_single_street_friendliness(sidewalk):
         return 0
 
 
-def parse_multilinestring(multilinestring_str):
-    # Remove the 'MultiLineString ((' and '))' from the string
-    multilinestring_str = multilinestring_str.replace("MultiLineString ((", "").replace(
-        "))", ""
-    )
-    linestrings = multilinestring_str.split("), (")
-    line_coords = []
-    for line in linestrings:
-        coords = []
-        for coord in line.split(", "):
-            try:
-                # Split coordinate into x and y
-                x_str, y_str = coord.strip().split()
-                x = float(x_str)
-                y = float(y_str)
-                coords.append((x, y))
-            except ValueError:
-                # Skip invalid coordinate pairs
-                continue
-        # Only add lines with at least two valid coordinates
-        if len(coords) >= 2:
-            line_coords.append(coords)
-    # Check if we have at least one valid linestring
-    if line_coords:
-        try:
-            return MultiLineString([LineString(coords) for coords in line_coords])
-        except ValueError as e:
-            print(f"Error creating MultiLineString: {e}")
-            return None
-    else:
-        return None  # Return None if no valid lines found
-
-
 def get_basic_statistics(sidewalks_gdf, district, heatmap_file):
-    # Reproject to a suitable projected CRS for accurate length and area calculations
-    sidewalks_gdf = sidewalks_gdf.to_crs(epsg=3857)
-    district = district.to_crs(epsg=3857)
-
+    # Both frames are in the metric CRS of the analysis, lengths are in metres
     good_streets = sidewalks_gdf[sidewalks_gdf["good"]]
     okay_streets = sidewalks_gdf[sidewalks_gdf["okay"]]
     bad_streets = sidewalks_gdf[sidewalks_gdf["bad"]]
 
     raw_total_length = sidewalks_gdf["length"].sum()
-    total_length = raw_total_length * 111320 / 1000
-    good_length = good_streets["length"].sum() * 111320 / 1000
-    okay_length = okay_streets["length"].sum() * 111320 / 1000
-    bad_length = bad_streets["length"].sum() * 111320 / 1000
+    total_length = raw_total_length / 1000
+    good_length = good_streets["length"].sum() / 1000
+    okay_length = okay_streets["length"].sum() / 1000
+    bad_length = bad_streets["length"].sum() / 1000
 
     percent_good = (good_length / total_length) * 100
     percent_okay = (okay_length / total_length) * 100
@@ -84,23 +49,13 @@ def get_basic_statistics(sidewalks_gdf, district, heatmap_file):
     if not heatmap_file:
         density = 0
     else:
-        # Load density information from the static file
-        density_df = pd.read_excel(
-            os.path.join(settings.STATICFILES_DIRS[0], heatmap_file.name)
+        # Load the compiled density information around the district
+        density_gdf = load_heatmap(
+            heatmap_path(heatmap_file), bbox=to_wgs84(district).total_bounds
         )
 
-        # Ensure the density_df has the correct columns
-        if not {"OBJECTID", "LICZBA", "boundaries"}.issubset(density_df.columns):
-            raise KeyError(
-                "The 'heatmap.xlsx' file is missing required columns: 'OBJECTID', 'LICZBA', 'boundaries'."
-            )
-
-        # Create geometries from the 'boundaries' column
-        density_df["geometry"] = density_df["boundaries"].apply(parse_multilinestring)
-        density_gdf = gpd.GeoDataFrame(density_df, geometry="geometry", crs="EPSG:4326")
-
         # Reproject to match the district CRS
-        density_gdf = density_gdf.to_crs(epsg=3857)
+        density_gdf = density_gdf.to_crs(district.crs)
 
         # Calculate total seniors within the district
         district_seniors = density_gdf[density_gdf.within(district.geometry.iloc[0])]
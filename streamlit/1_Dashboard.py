@@ -1,34 +1,27 @@
 import os
+import numpy as np
 import osmnx as ox
 import streamlit as st
 from streamlit_folium import st_folium
-from geopy.geocoders import Nominatim
 
 # Set page configuration for Dashboard
 st.set_page_config(layout="wide", page_title="Dashboard", page_icon="🗺️")
 
 # Import utilities
-from utils.districts import get_districts, get_district_geodataframe
-from utils.heatmap import generate_heatmap, generate_heatmap_layer
-from utils.map_utils import initialize_map, add_district_boundaries
-from utils.benches_sidewalks import (
-    calculate_benches,
-    get_sidewalks,
-    get_benches,
-    assign_benches_to_sidewalks,
-)
-from utils.drawing import draw_benches, draw_sidewalks
-from utils.classification import classify_sidewalks
-from utils.simulation import add_optimized_benches
-from utils.statistics import get_basic_statistics
+from utils.districts import get_districts
+from utils.heatmap import clear_heatmaps, generate_heatmap, generate_heatmap_layer
+from utils.map_utils import initialize_map
+from utils.benches_sidewalks import calculate_benches
+from utils.drawing import draw_benches, draw_district, draw_sidewalks
+from utils.classification import sweep_classification
+from utils.geocoding import geocode
+from utils.pipeline import run_pipeline
+
 
 # Initialize session state for simulation status
 if "simulate_status" not in st.session_state:
     st.session_state.simulate_status = False
 
-# Get geolocator
-geolocator = Nominatim(user_agent="street-highlighter")
-
 # Sidebar for user input
 with st.sidebar:
     admin_level = st.slider(
@@ -45,7 +38,17 @@ with st.sidebar:
         .capitalize()
         .strip()
     )
-    districts = get_districts(city, admin_level + 6)
+
+    refresh_data = st.button(
+        "Refresh OSM data",
+        help="ℹ️ Ignore the stored snapshots and fetch districts, streets and benches again.",
+    )
+    if refresh_data:
+        st.cache_data.clear()
+        clear_heatmaps()
+        # The pipeline stages are cleared by run_pipeline
+
+    districts = get_districts(city, admin_level + 6, refresh=refresh_data)
     district_name = st.selectbox(
         "Define area:",
         [""] + districts,
@@ -79,7 +82,12 @@ with st.sidebar:
     if district_name == "":
         # Handle heatmap
         st.warning("You can select a district or see the heatmap.")
-        heatmap_map = generate_heatmap(city, heatmap_file)
+        raster_heatmap = st.checkbox(
+            "Raster heatmap",
+            value=True,
+            help="ℹ️ Show the heatmap as one pre-rendered image, which is much lighter than the polygons of all blocks.",
+        )
+        heatmap_map = generate_heatmap(city, heatmap_file, raster=raster_heatmap)
     else:
         # Handle districts and main functionality
         if district_name == city:
@@ -173,16 +181,12 @@ with st.sidebar:
                 )
             col7, col8 = st.columns(2)
             with col7:
-                good_street_value = (
-                    st.slider("Optimal distance", min_value=0, max_value=300, value=50)
-                    / 111320
+                good_street_value = st.slider(
+                    "Optimal distance", min_value=0, max_value=300, value=50
                 )
             with col8:
-                okay_street_value = (
-                    st.slider(
-                        "Convenient distance", min_value=0, max_value=300, value=150
-                    )
-                    / 111320
+                okay_street_value = st.slider(
+                    "Convenient distance", min_value=0, max_value=300, value=150
                 )
 
     with st.expander("Advanced Road Options"):
@@ -251,57 +255,44 @@ else:
     step_text.text("Finding location...")
 
     # Find location
-    location = geolocator.geocode(location_name)
+    location = geocode(location_name)
 
     # Create Folium map
     progress_bar.progress(10)
     step_text.text("Creating map...")
     m = initialize_map(location)
 
-    # Add district boundaries
+    # Run the cached analysis stages, only the stages whose inputs changed are
+    # computed again
     progress_bar.progress(20)
-    step_text.text("Adding district boundaries...")
-    m = add_district_boundaries(m, location_name)
-
-    # Get district geodataframe
-    district = get_district_geodataframe(location_name)
-
-    # Find sidewalks inside the district
-    progress_bar.progress(30)
-    step_text.text("Finding sidewalks...")
-    sidewalks_gdf = get_sidewalks(location_name, selected_highway_types)
-
-    # Find benches inside the district
-    progress_bar.progress(40)
-    step_text.text("Finding benches...")
-    benches_gdf = get_benches(location_name, district, benches_file)
-
-    progress_bar.progress(50)
-    step_text.text("Assigning benches to sidewalks...")
-    sidewalks_gdf = assign_benches_to_sidewalks(sidewalks_gdf, benches_gdf)
-
-    # If simulation is activated
-    if (
+    step_text.text("Analysing sidewalks and benches...")
+    simulation = (
         st.session_state.simulate_status
         and budget is not None
         and bench_cost is not None
-    ):
-        num_benches = calculate_benches(budget, bench_cost)
-        benches_gdf = add_optimized_benches(
-            benches_gdf, sidewalks_gdf, num_benches, good_street_value
-        )
-        sidewalks_gdf = assign_benches_to_sidewalks(sidewalks_gdf, benches_gdf)
+    )
+    analysis = run_pipeline(
+        location_name,
+        selected_highway_types,
+        benches_file,
+        heatmap_file,
+        good_street_value,
+        okay_street_value,
+        num_benches=calculate_benches(budget, bench_cost) if simulation else None,
+        bench_cost=bench_cost if simulation else None,
+        admin_level=admin_level + 6,
+        refresh=refresh_data,
+    )
 
+    # Add district boundaries
     progress_bar.progress(60)
-    step_text.text("Drawing benches...")
-    if show_benches:
-        m = draw_benches(m, benches_gdf)
+    step_text.text("Adding district boundaries...")
+    m = draw_district(m, analysis.district)
 
     progress_bar.progress(70)
-    step_text.text("Classifying sidewalks...")
-    sidewalks_class = classify_sidewalks(
-        sidewalks_gdf, good_street_value, okay_street_value
-    )
+    step_text.text("Drawing benches...")
+    if show_benches:
+        m = draw_benches(m, analysis.benches)
 
     progress_bar.progress(80)
     step_text.text("Drawing map...")
@@ -319,22 +310,18 @@ else:
         "one_street_color": one_street_color,
         "zero_street_color": zero_street_color,
     }
-    m = draw_sidewalks(m, sidewalks_class, show_options, colors)
+    # The geometries are already reduced for the map
+    m = draw_sidewalks(m, analysis.sidewalks, show_options, colors, zoom=None)
 
     # Add heatmap overlay if enabled
     if show_heatmap_overlay:
-        m = generate_heatmap_layer(m, heatmap_file, district, heatmap_opacity)
-
-    # Calculate statistics
-    progress_bar.progress(90)
-    step_text.text("Calculating statistics...")
-    street_stats, general_stats = get_basic_statistics(
-        sidewalks_class, benches_gdf, district, heatmap_file
-    )
+        m = generate_heatmap_layer(m, heatmap_file, analysis.district, heatmap_opacity)
 
     # Generate statistics HTML
-    stats_html = street_stats.to_html(classes="table-style", index=False)
-    stats_html += general_stats.to_html(classes="table-style", index=False)
+    progress_bar.progress(90)
+    step_text.text("Loading statistics...")
+    stats_html = analysis.street_stats.to_html(classes="table-style", index=False)
+    stats_html += analysis.general_stats.to_html(classes="table-style", index=False)
 
     # Display the map using st_folium for better responsiveness
     progress_bar.progress(99)
@@ -371,6 +358,35 @@ else:
     # Display the statistics
     st.markdown(stats_html, unsafe_allow_html=True)
 
+    # Friendliness after every simulated bench, up to the whole budget
+    budget_curve = analysis.budget_curve
+    if budget_curve is not None:
+        with st.expander("Budget curve"):
+            st.line_chart(budget_curve.set_index("cost")[["friendliness"]])
+            st.line_chart(
+                budget_curve.set_index("cost")[
+                    ["good_length_km", "okay_length_km", "bad_length_km"]
+                ]
+            )
+            st.dataframe(budget_curve, hide_index=True)
+            st.download_button(
+                "Download curve (JSON)",
+                budget_curve.to_json(orient="records"),
+                file_name="budget_curve.json",
+                mime="application/json",
+            )
+
+    # Share of the street length per class for every optimal distance
+    with st.expander("Threshold sensitivity"):
+        distances = np.arange(0, 301, 5)
+        sweep = sweep_classification(
+            analysis.profiles, distances, okay_street_value
+        )
+        st.line_chart(sweep.set_index("threshold") * 100)
+        st.caption(
+            "Percentage of the street length that is optimal, convenient or insufficient for each optimal distance (m), with the current convenient distance."
+        )
+
     # Reset progress bar
     progress_bar.empty()
     step_text.empty()
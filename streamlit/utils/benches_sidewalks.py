@@ -1,27 +1,29 @@
-from geopy.geocoders import Nominatim
-import osmnx as ox
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import Point
 import streamlit as st
+from utils.feature_sources import get_feature_source
+from utils.geocoding import geocode
+from utils.projection import to_crs
+from utils.snapshots import cached_snapshot
 
-geolocator = Nominatim(user_agent="age_friendly")
+BENCH_TAGS = {"amenity": "bench"}
+# Benches closer to a sidewalk than this (in metres) are assigned to it
+BENCH_DISTANCE = 11
+# Shorter sidewalks (in metres) are dropped
+MIN_SIDEWALK_LENGTH = 55
 
 
 def get_location(location_name):
-    return geolocator.geocode(location_name)
+    return geocode(location_name)
 
 
-@st.cache_data
-def get_sidewalks(location_name, highway_types=None):
-    # If no highway_types passed, use default
-    if not highway_types:
-        highway_types = ["footway", "pedestrian", "living_street"]
-
-    # Fetch features from OSM using the selected highway types
-    sidewalks_gdf = ox.features_from_place(
-        location_name,
-        tags={"highway": highway_types}
+def fetch_sidewalks(location_name, highway_types, admin_level=None, source=None):
+    # Fetch features from OSM (or the local extract) using the selected highway types
+    source = source or get_feature_source()
+    sidewalks_gdf = source.features(
+        location_name, {"highway": highway_types}, admin_level
     )
 
     # Data preprocessing as before
@@ -32,19 +34,58 @@ def get_sidewalks(location_name, highway_types=None):
     if "footway" in sidewalks_gdf.columns:
         if (sidewalks_gdf["footway"] == "crossing").any():
             sidewalks_gdf = sidewalks_gdf[sidewalks_gdf["footway"] != "crossing"]
-    # Calculate the length of each sidewalk
+    # Calculate the length of each sidewalk in metres
 
+    sidewalks_gdf = sidewalks_gdf.to_crs(sidewalks_gdf.estimate_utm_crs())
     sidewalks_gdf["length"] = sidewalks_gdf.geometry.length
     # Remove short sidewalks from the original GeoDataFrame
-    sidewalks_gdf = sidewalks_gdf[sidewalks_gdf["length"] >= 0.0005]
+    sidewalks_gdf = sidewalks_gdf[sidewalks_gdf["length"] >= MIN_SIDEWALK_LENGTH]
     return sidewalks_gdf
 
 
+@st.cache_data
+def get_sidewalks(
+    location_name, highway_types=None, admin_level=None, refresh=False, _source=None
+):
+    # If no highway_types passed, use default
+    if not highway_types:
+        highway_types = ["footway", "pedestrian", "living_street"]
+
+    # Reuse the stored snapshot of the preprocessed sidewalks while it is fresh
+    return cached_snapshot(
+        "sidewalks",
+        lambda: fetch_sidewalks(location_name, highway_types, admin_level, _source),
+        location_name,
+        tags={"highway": sorted(highway_types)},
+        admin_level=admin_level,
+        refresh=refresh,
+    )
 
-def get_benches(location_name, district, benches_file=None):
+
+def fetch_benches(location_name, admin_level=None, source=None):
+    source = source or get_feature_source()
     # Find benches inside the district
+    return source.features(location_name, BENCH_TAGS, admin_level)
+
+
+def get_benches(
+    location_name,
+    district,
+    benches_file=None,
+    admin_level=None,
+    source=None,
+    refresh=False,
+):
+    # OSM benches come from the snapshot store, the imported file is merged on top
     try:
-        benches_gdf = ox.features_from_place(location_name, tags={"amenity": "bench"})
+        benches_gdf = cached_snapshot(
+            "benches",
+            lambda: fetch_benches(location_name, admin_level, source),
+            location_name,
+            tags=BENCH_TAGS,
+            admin_level=admin_level,
+            refresh=refresh,
+        )
     except:
         st.error("We don't have data for this location :(")
         st.stop()
@@ -69,14 +110,28 @@ def get_benches(location_name, district, benches_file=None):
     return benches_gdf
 
 
-def assign_benches_to_sidewalks(sidewalks_gdf, benches_gdf):
-    # Buffer sidewalks slightly to include nearby benches
-    buffer_sidewalks = sidewalks_gdf.geometry.buffer(
-        0.0001
-    )  # Adjust buffer size as needed
-    sidewalks_gdf["benches"] = buffer_sidewalks.apply(
-        lambda x: benches_gdf[benches_gdf.within(x)].geometry.tolist()
+def assign_benches_to_sidewalks(sidewalks_gdf, benches_gdf, distance=BENCH_DISTANCE):
+    if sidewalks_gdf.empty:
+        sidewalks_gdf["benches"] = []
+        return sidewalks_gdf
+
+    # Both frames are expected in the metric CRS of the analysis
+    sidewalks = sidewalks_gdf.geometry
+    benches = to_crs(benches_gdf, sidewalks_gdf.crs).geometry
+
+    # Find all (bench, sidewalk) pairs closer than `distance` with the spatial index
+    bench_idx, sidewalk_idx = sidewalks.sindex.query(
+        benches.values, predicate="dwithin", distance=distance
     )
+
+    # Group the benches by sidewalk, keeping the order of the benches table
+    order = np.lexsort((bench_idx, sidewalk_idx))
+    bench_idx, sidewalk_idx = bench_idx[order], sidewalk_idx[order]
+    splits = np.searchsorted(sidewalk_idx, np.arange(1, len(sidewalks_gdf)))
+    bench_geometries = benches.values
+    sidewalks_gdf["benches"] = [
+        list(bench_geometries[idx]) for idx in np.split(bench_idx, splits)
+    ]
     return sidewalks_gdf
 
 
@@ -1,33 +1,114 @@
+import pandas as pd
+import geopandas as gpd
 import requests
-import osmnx as ox
+import shapely
 import streamlit as st
+from utils.geocoding import geocode_to_gdf
+from utils.overpass import overpass_query, quote
+from utils.snapshots import cached_snapshot
+
+# All administrative areas of a city are fetched at once with their
+# boundaries and kept as a catalogue in the snapshot store, so that district
+# lists, boundaries and point lookups need no further requests. Levels go
+# from the largest areas (7) down to neighbourhoods (11)
+ADMIN_LEVELS = range(7, 12)
+
+
+def _relation_geometry(relation):
+    # (Multi)polygon of a boundary relation from the ways of its outer and
+    # inner rings, which may each be split into several ways
+    lines = {"outer": [], "inner": []}
+    for member in relation.get("members", []):
+        points = member.get("geometry") or []
+        if member["type"] == "way" and member.get("role") in lines and len(points) > 1:
+            lines[member["role"]].append(
+                shapely.LineString([(point["lon"], point["lat"]) for point in points])
+            )
+
+    def area(lines):
+        if not lines:
+            return shapely.Polygon()
+        rings = shapely.get_parts(shapely.union_all(lines))
+        return shapely.union_all(shapely.get_parts(shapely.polygonize(rings)))
+
+    return shapely.make_valid(area(lines["outer"]).difference(area(lines["inner"])))
+
+
+def _parents(catalogue):
+    # The parent of an area is the smallest area of a lower level containing it
+    parents = pd.Series(pd.NA, index=catalogue.index, dtype="Int64")
+    if catalogue.empty:
+        return parents
+    points = catalogue.geometry.representative_point()
+    child, parent = catalogue.sindex.query(points, predicate="within")
+    levels = catalogue["admin_level"].to_numpy()
+    pairs = pd.DataFrame(
+        {
+            "child": child,
+            "parent": catalogue["osm_id"].to_numpy()[parent],
+            "area": shapely.area(catalogue.geometry.values[parent]),
+        }
+    )[levels[parent] < levels[child]]
+    pairs = pairs.sort_values("area").drop_duplicates("child")
+    parents.iloc[pairs["child"].to_numpy()] = pairs["parent"].to_numpy()
+    return parents
+
+
+def fetch_district_catalogue(city_name, refresh=False):
+    # One query for the administrative relations of every level with geometry
+    levels = "|".join(str(level) for level in ADMIN_LEVELS)
+    data = overpass_query(
+        f"""
+        area[name={quote(city_name)}]->.searchArea;
+        (
+          rel(area.searchArea)["admin_level"~"^({levels})$"];
+        );
+        out geom;
+        """,
+        refresh=refresh,
+    )
+
+    rows = []
+    for element in data["elements"]:
+        tags = element.get("tags", {})
+        if element["type"] != "relation" or "name" not in tags:
+            continue
+        try:
+            admin_level = int(tags["admin_level"])
+        except (KeyError, ValueError):
+            continue
+        geometry = _relation_geometry(element)
+        if geometry.is_empty:
+            continue
+        rows.append((element["id"], tags["name"], admin_level, geometry))
+
+    osm_ids, names, admin_levels, geometries = zip(*rows) if rows else ([], [], [], [])
+    catalogue = gpd.GeoDataFrame(
+        {
+            "osm_id": pd.Series(osm_ids, dtype="int64"),
+            "name": pd.Series(names, dtype=object),
+            "admin_level": pd.Series(admin_levels, dtype="int64"),
+        },
+        geometry=gpd.GeoSeries(list(geometries), crs="EPSG:4326"),
+    )
+    catalogue["parent"] = _parents(catalogue)
+    return catalogue
+
+
+def get_district_catalogue(city_name, refresh=False):
+    return cached_snapshot(
+        "district_catalogues",
+        lambda: fetch_district_catalogue(city_name, refresh),
+        city_name,
+        refresh=refresh,
+    )
 
 
 @st.cache_data
-def get_districts(city_name, admin_level=9):
-    # Overpass API Query
-    query = f"""
-    [out:json];
-    area[name="{city_name}"]->.searchArea;
-    (
-      rel(area.searchArea)["admin_level"="{admin_level}"];
-    );
-    out body;
-    """
-
-    # URL of the Overpass API
-    url = "http://overpass-api.de/api/interpreter"
-
-    # Send request to Overpass API
-    response = requests.get(url, params={"data": query})
-    data = response.json()
-
-    # Extract district names
-    districts = [
-        element["tags"]["name"]
-        for element in data["elements"]
-        if "name" in element["tags"]
-    ]
+def get_districts(city_name, admin_level=9, refresh=False):
+    catalogue = get_district_catalogue(city_name, refresh=refresh)
+    names = catalogue.loc[catalogue["admin_level"] == int(admin_level), "name"]
+    districts = names.drop_duplicates().tolist()
 
     # Sort districts alphabetically
     districts.sort()
@@ -35,6 +116,60 @@ def get_districts(city_name, admin_level=9):
     return districts
 
 
+def _find(catalogue, district_name, admin_level=None):
+    # The same name is often used on several levels (e.g. a district and its
+    # largest neighbourhood), the area of the given level is preferred and
+    # the largest area is used if the name is not found on it
+    matches = catalogue[catalogue["name"] == district_name]
+    if admin_level is not None:
+        on_level = matches[matches["admin_level"] == int(admin_level)]
+        if not on_level.empty:
+            matches = on_level
+    if matches.empty:
+        return None
+    return matches.sort_values("admin_level").iloc[[0]].reset_index(drop=True)
+
+
+def get_district_boundary(city_name, district_name, admin_level=None, refresh=False):
+    # Boundary of a district of the catalogue, None if it has no such district
+    catalogue = get_district_catalogue(city_name, refresh=refresh)
+    return _find(catalogue, district_name, admin_level)
+
+
+def get_subdistricts(city_name, district_name, admin_level=None, refresh=False):
+    # Names of the areas directly inside a district
+    catalogue = get_district_catalogue(city_name, refresh=refresh)
+    district = _find(catalogue, district_name, admin_level)
+    if district is None:
+        return []
+    children = catalogue[catalogue["parent"] == district["osm_id"][0]]
+    return children["name"].drop_duplicates().tolist()
+
+
+def find_district(city_name, longitude, latitude, admin_level=9, refresh=False):
+    # Name of the district of the given level containing a point, or None
+    catalogue = get_district_catalogue(city_name, refresh=refresh)
+    catalogue = catalogue[catalogue["admin_level"] == int(admin_level)]
+    matches = catalogue.sindex.query(shapely.Point(longitude, latitude), predicate="within")
+    if len(matches) == 0:
+        return None
+    return catalogue["name"].iloc[matches[0]]
+
+
 @st.cache_data
-def get_district_geodataframe(location_name):
-    return ox.geocode_to_gdf(location_name)
+def get_district_geodataframe(location_name, admin_level=None, refresh=False):
+    # Districts ("District, City") come from the catalogue of their city, any
+    # other place and districts missing from it are geocoded. `admin_level` is
+    # the level the district was picked from
+    district_name, _, city_name = location_name.rpartition(", ")
+    if district_name:
+        try:
+            district = get_district_boundary(
+                city_name, district_name, admin_level, refresh=refresh
+            )
+        except (requests.RequestException, RuntimeError) as e:
+            print(f"Could not load the districts of {city_name}: {e}")
+            district = None
+        if district is not None:
+            return district
+    return geocode_to_gdf(location_name, refresh=refresh)
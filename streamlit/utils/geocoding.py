@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+from datetime import timedelta
+
+import osmnx as ox
+from geopy.geocoders import Nominatim
+from utils.snapshots import cached_snapshot
+
+geolocator = Nominatim(user_agent="age_friendly")
+
+# Nominatim usage policy: no more than one request per second
+MIN_REQUEST_INTERVAL = 1.0
+
+Location = namedtuple("Location", ["latitude", "longitude", "address"])
+
+GEOCODE_CACHE_DIR = os.environ.get(
+    "GEOCODE_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "geocoding"),
+)
+GEOCODE_TTL_DAYS = int(os.environ.get("GEOCODE_TTL_DAYS", 90))
+
+_rate_lock = threading.Lock()
+_last_request = 0.0
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def _wait_for_rate_limit():
+    # Space out upstream requests of all threads in this process
+    global _last_request
+    with _rate_lock:
+        delay = _last_request + MIN_REQUEST_INTERVAL - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        _last_request = time.monotonic()
+
+
+def _coalesce(key, fetch):
+    # Concurrent callers asking for the same key wait for a single upstream call
+    with _inflight_lock:
+        future = _inflight.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            _inflight[key] = future
+    if not is_owner:
+        return future.result()
+
+    try:
+        result = fetch()
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+
+def _ttl():
+    return timedelta(days=GEOCODE_TTL_DAYS)
+
+
+def _point_path(location_name):
+    digest = hashlib.sha256(location_name.encode("utf-8")).hexdigest()[:32]
+    return os.path.join(GEOCODE_CACHE_DIR, f"{digest}.json")
+
+
+def _read_point(location_name):
+    path = _point_path(location_name)
+    if not os.path.exists(path):
+        return None
+    if time.time() - os.path.getmtime(path) > _ttl().total_seconds():
+        return None
+    with open(path, encoding="utf-8") as f:
+        return Location(**json.load(f))
+
+
+def _write_point(location_name, location):
+    path = _point_path(location_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(location._asdict(), f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def geocode(location_name):
+    # Point geocoding with a persistent cache, failed lookups are not cached
+    location = _read_point(location_name)
+    if location is not None:
+        return location
+
+    def fetch():
+        _wait_for_rate_limit()
+        result = geolocator.geocode(location_name)
+        if result is None:
+            return None
+        location = Location(result.latitude, result.longitude, result.address)
+        _write_point(location_name, location)
+        return location
+
+    return _coalesce(("point", location_name), fetch)
+
+
+def geocode_to_gdf(location_name, refresh=False):
+    # Boundary geocoding, the results are kept in the snapshot store
+    def fetch():
+        _wait_for_rate_limit()
+        return ox.geocode_to_gdf(location_name)
+
+    return _coalesce(
+        ("boundary", location_name, refresh),
+        lambda: cached_snapshot(
+            "boundaries", fetch, location_name, refresh=refresh, ttl=_ttl()
+        ),
+    )
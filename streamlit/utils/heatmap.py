@@ -1,44 +1,26 @@
 import folium
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Polygon
 import streamlit as st
-from geopy.geocoders import Nominatim
+from utils.drawing import draw_heatmap
+from utils.geocoding import geocode
+from utils.heatmap_data import heatmap_digest, load_heatmap
+from utils.heatmap_tiles import heatmap_overlay
+from utils.projection import to_wgs84
 
-geolocator = Nominatim(user_agent="age_friendly")
+# Number of clipped heatmaps kept in memory
+CLIPPED_HEATMAPS = 32
 
 
 @st.cache_data
-def generate_heatmap(location_name, heatmap_file_path):
-    location = geolocator.geocode(location_name)
+def generate_heatmap(location_name, heatmap_file_path, raster=False):
+    location = geocode(location_name)
 
-    # Read data from Excel file
-    df = pd.read_excel(heatmap_file_path)
+    # Load the compiled heatmap
+    df = load_heatmap(heatmap_file_path)
 
-    inhabitants = sorted(set(df["LICZBA"].tolist()))
-
-    # Clean up 'boundaries' column in df
-    df["boundaries"] = df["boundaries"].str.replace(
-        r"^MultiLineString \(\(", "", regex=True
-    )
-    df["boundaries"] = df["boundaries"].str.replace(r"\)\)$", "", regex=True)
-
-    problematic_ids = [
-        2503,
-        2760,
-        3255,
-        3535,
-        3546,
-        3564,
-        3565,
-        3566,
-        3576,
-        3579,
-        3583,
-        3601,
-        3645,
-    ]
-    df_filtered = df[~df["OBJECTID"].isin(problematic_ids)]
+    inhabitants = np.unique(df["LICZBA"])
 
     # Create a Folium map centered at the location
     m = folium.Map(
@@ -49,103 +31,54 @@ def generate_heatmap(location_name, heatmap_file_path):
         control_scale=True,
     )
 
-    for _, row in df_filtered.iterrows():
-        # Split the string into individual coordinate pairs
-        coordinate_pairs = row["boundaries"].split(", ")
+    if raster:
+        # One pre-rendered image instead of thousands of polygons
+        image, bounds = heatmap_overlay(heatmap_file_path)
+        folium.raster_layers.ImageOverlay(image, bounds, name="Population").add_to(m)
+    else:
+        m = draw_heatmap(m, df, inhabitants)
 
-        # Calculate the color based on the value of inhabitants
-        color = color_B_to_R(inhabitants, row["LICZBA"])
+    return m._repr_html_()
 
-        # Convert each coordinate pair into a tuple of floats
-        points = [tuple(map(float, pair.split())) for pair in coordinate_pairs]
 
-        # Create a Shapely Polygon from the list of points
-        polygon = Polygon(points)
+@st.cache_resource(max_entries=CLIPPED_HEATMAPS, show_spinner=False)
+def _clip_heatmap(heatmap_key, district_key, _heatmap_file_path, _district):
+    # Keyed by the heatmap content and the district boundary (arguments
+    # starting with "_" are not hashed). The result is shared and read-only
+    gdf = load_heatmap(_heatmap_file_path)
+    # The spatial index finds the blocks intersecting the district, the clip
+    # cuts them at its boundary
+    candidates = gdf.iloc[sorted(gdf.sindex.query(_district, predicate="intersects"))]
+    return (
+        gpd.clip(candidates, _district, keep_geom_type=True),
+        np.unique(gdf["LICZBA"]),
+    )
 
-        # Convert the Polygon to a GeoJSON feature
-        feature = gpd.GeoSeries([polygon]).__geo_interface__
 
-        # Add the GeoJSON feature to the Folium map
-        folium.GeoJson(
-            feature,
-            style_function=lambda x, color=color: {
-                "fillColor": color,
-                "color": color,
-                "weight": 2.5,
-                "fillOpacity": 0.3,
-            },
-            tooltip=f"{row['LICZBA']} people",
-        ).add_to(m)
+def clip_heatmap(heatmap_file_path, district_gdf):
+    # Population blocks inside the district, computed once per heatmap file and
+    # district so that toggling the overlay or changing the opacity only
+    # restyles the clipped blocks
+    district = to_wgs84(district_gdf).geometry.union_all()
+    return _clip_heatmap(
+        heatmap_digest(heatmap_file_path), district.wkb, heatmap_file_path, district
+    )
 
-    return m._repr_html_()
 
+def clear_heatmaps():
+    _clip_heatmap.clear()
 
-def generate_heatmap_layer(m, heatmap_file_path, district_gdf, opacity):
-    # Read data from Excel file
-    df = pd.read_excel(heatmap_file_path)
 
-    # Clean up 'boundaries' column in df
-    df["boundaries"] = df["boundaries"].str.replace(
-        r"^MultiLineString \(\(", "", regex=True
-    )
-    df["boundaries"] = df["boundaries"].str.replace(r"\)\)$", "", regex=True)
-
-    problematic_ids = [
-        2503,
-        2760,
-        3255,
-        3535,
-        3546,
-        3564,
-        3565,
-        3566,
-        3576,
-        3579,
-        3583,
-        3601,
-        3645,
-    ]
-    df_filtered = df[~df["OBJECTID"].isin(problematic_ids)]
-
-    # Create geometry from 'boundaries' column
-    def boundary_to_polygon(boundary_str):
-        coordinate_pairs = boundary_str.split(", ")
-        points = [tuple(map(float, pair.split())) for pair in coordinate_pairs]
-        polygon = Polygon(points)
-        return polygon
-
-    df_filtered["geometry"] = df_filtered["boundaries"].apply(boundary_to_polygon)
-    gdf = gpd.GeoDataFrame(df_filtered, geometry="geometry")
-    gdf.set_crs(epsg=4326, inplace=True)
-    district_gdf = district_gdf.to_crs(epsg=4326)
-
-    # Get polygons within the district
-    gdf_in_district = gpd.overlay(gdf, district_gdf, how="intersection")
-    inhabitants = sorted(set(df["LICZBA"].tolist()))
+def generate_heatmap_layer(m, heatmap_file_path, district_gdf, opacity):
+    gdf_in_district, inhabitants = clip_heatmap(heatmap_file_path, district_gdf)
 
     # Add polygons to the map
-    for _, row in gdf_in_district.iterrows():
-        color = color_B_to_R(inhabitants, row["LICZBA"])
-        feature = folium.GeoJson(
-            row["geometry"],
-            style_function=lambda x, color=color: {
-                "fillColor": color,
-                "color": color,
-                "weight": opacity * 5 if opacity < 0.5 else 2.5,
-                "fillOpacity": opacity,
-            },
-            tooltip=f"{row['LICZBA']} people",
-        )
-        feature.add_to(m)
+    m = draw_heatmap(
+        m,
+        gdf_in_district,
+        inhabitants,
+        opacity=opacity,
+        weight=opacity * 5 if opacity < 0.5 else 2.5,
+    )
 
     return m
-
-
-def color_B_to_R(inhabitants, value):
-    index = inhabitants.index(value)
-    ratio = index / len(inhabitants)
-    red_value = int((1 - ratio) * 255)  # More red when ratio is close to 0
-    blue_value = int(ratio * 255)  # More blue when ratio is close to 1
-    # create a color in RGB format
-    color = f"#{blue_value:02X}00{red_value:02X}"
-    return color
@@ -0,0 +1,129 @@
+import io
+import os
+import hashlib
+import threading
+
+import pandas as pd
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import box
+
+# Bump when the compilation changes so that old artifacts are not reused
+HEATMAP_VERSION = 2
+
+HEATMAP_CACHE_DIR = os.environ.get(
+    "HEATMAP_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "heatmaps"),
+)
+
+# In-process copies of the compiled heatmaps, by content hash
+_heatmaps = {}
+_lock = threading.Lock()
+
+
+def _read_bytes(heatmap_file):
+    # The heatmap is either a path in the static folder or an uploaded file
+    if isinstance(heatmap_file, (str, os.PathLike)):
+        with open(heatmap_file, "rb") as f:
+            return f.read()
+    return heatmap_file.getvalue()
+
+
+def file_digest(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def heatmap_digest(heatmap_file):
+    return file_digest(_read_bytes(heatmap_file))
+
+
+def _artifact_path(digest):
+    return os.path.join(HEATMAP_CACHE_DIR, f"{digest}-v{HEATMAP_VERSION}.parquet")
+
+
+def _repair_boundary(wkt):
+    # Fallback for boundaries the bulk parser can't turn into polygons
+    if not isinstance(wkt, str):
+        return None
+    lines = shapely.from_wkt(wkt, on_invalid="ignore")
+    if lines is None:
+        # Excel cuts cells at 32767 characters, drop the partial last coordinate
+        lines = shapely.from_wkt(wkt[: wkt.rfind(",")] + "))", on_invalid="ignore")
+        if lines is None:
+            return None
+    # Close open rings
+    try:
+        rings = [
+            shapely.linearrings(shapely.get_coordinates(part))
+            for part in shapely.get_parts(lines)
+        ]
+    except (ValueError, shapely.errors.GEOSException):
+        return None
+    polygon = shapely.build_area(shapely.multilinestrings(rings))
+    if polygon.is_empty:
+        # Closing a truncated ring can make it self-intersecting, which
+        # build_area can't polygonize, the validity pass fixes it instead
+        polygon = shapely.polygons(rings[0], holes=rings[1:] or None)
+    return polygon
+
+
+def compile_heatmap(data):
+    # Parse the workbook into polygons with the number of inhabitants
+    df = pd.read_excel(io.BytesIO(data))
+
+    # Ensure the workbook has the correct columns
+    if not {"OBJECTID", "LICZBA", "boundaries"}.issubset(df.columns):
+        raise KeyError(
+            "The heatmap file is missing required columns: 'OBJECTID', 'LICZBA', 'boundaries'."
+        )
+
+    # The boundaries are MultiLineString WKT with one closed ring per part,
+    # inner rings become holes
+    wkt = df["boundaries"].to_numpy(dtype=object)
+    polygons = shapely.build_area(shapely.from_wkt(wkt, on_invalid="ignore"))
+
+    needs_repair = np.flatnonzero(shapely.is_missing(polygons) | shapely.is_empty(polygons))
+    for i in needs_repair:
+        polygons[i] = _repair_boundary(wkt[i])
+
+    invalid = np.flatnonzero(~shapely.is_valid(polygons) & ~shapely.is_missing(polygons))
+    polygons[invalid] = shapely.make_valid(polygons[invalid])
+
+    polygonal = np.isin(shapely.get_type_id(polygons), [3, 6]) & ~shapely.is_empty(polygons)
+    dropped = df["OBJECTID"][~polygonal].tolist()
+    if len(needs_repair) or len(invalid) or dropped:
+        print(
+            f"Heatmap: repaired {polygonal[needs_repair].sum()} boundaries, "
+            f"fixed {len(invalid)} invalid polygons, dropped OBJECTID {dropped}"
+        )
+
+    gdf = gpd.GeoDataFrame(
+        df[["OBJECTID", "LICZBA"]], geometry=polygons, crs="EPSG:4326"
+    )
+    return gdf[polygonal].reset_index(drop=True)
+
+
+def load_heatmap(heatmap_file, bbox=None):
+    # Compile the workbook on first use, later calls read the GeoParquet
+    # artifact (or the in-process copy) instead of the workbook
+    data = _read_bytes(heatmap_file)
+    digest = file_digest(data)
+    with _lock:
+        if digest not in _heatmaps:
+            artifact = _artifact_path(digest)
+            if os.path.exists(artifact):
+                gdf = gpd.read_parquet(artifact)
+            else:
+                gdf = compile_heatmap(data)
+                os.makedirs(os.path.dirname(artifact), exist_ok=True)
+                tmp_path = f"{artifact}.{os.getpid()}.tmp"
+                gdf.to_parquet(tmp_path, write_covering_bbox=True)
+                os.replace(tmp_path, artifact)
+            _heatmaps[digest] = gdf
+        gdf = _heatmaps[digest]
+
+    if bbox is None:
+        return gdf
+    # Preselect the polygons intersecting the bbox (WGS84) with the spatial index
+    return gdf.iloc[sorted(gdf.sindex.query(box(*bbox), predicate="intersects"))]
@@ -0,0 +1,69 @@
+import os
+import base64
+
+import numpy as np
+import shapely
+from folium.utilities import write_png
+from utils.drawing import inhabitants_ratio
+from utils.heatmap_data import HEATMAP_CACHE_DIR, heatmap_digest, load_heatmap
+
+# Width in pixels of the pre-rendered heatmap image
+OVERLAY_WIDTH = 1024
+# Opacity of the blocks (0-255), the same as the fill of the vector heatmap
+OVERLAY_ALPHA = 77
+
+
+def _overlay_path(digest):
+    return os.path.join(
+        HEATMAP_CACHE_DIR, "overlays", f"{digest}-{OVERLAY_WIDTH}.png"
+    )
+
+
+def _pixel_centers(bounds, width=OVERLAY_WIDTH):
+    # Longitudes and latitudes of the pixel centers of an image covering the
+    # bounds with rows evenly spaced in Web Mercator, so that it can be shown
+    # without reprojection, the first row is the northern edge
+    west, south, east, north = bounds
+    top, bottom = np.arcsinh(np.tan(np.radians([north, south])))
+    height = max(int(round(width * (top - bottom) / np.radians(east - west))), 1)
+    lons = west + (np.arange(width) + 0.5) / width * (east - west)
+    rows = top - (np.arange(height) + 0.5) / height * (top - bottom)
+    lats = np.degrees(np.arctan(np.sinh(rows)))
+    return np.meshgrid(lons, lats)
+
+
+def rasterize(heatmap_gdf, inhabitants, lons, lats):
+    # RGBA image with the color of the block containing every pixel center,
+    # the point-in-polygon tests run in bulk on the spatial index
+    image = np.zeros(lons.shape + (4,), dtype=np.uint8)
+    points = shapely.points(lons.ravel(), lats.ravel())
+    point_idx, block_idx = heatmap_gdf.sindex.query(points, predicate="within")
+    ratio = inhabitants_ratio(inhabitants, heatmap_gdf["LICZBA"].to_numpy()[block_idx])
+
+    # Same colors as color_B_to_R
+    pixels = image.reshape(-1, 4)
+    pixels[point_idx, 0] = (ratio * 255).astype(int)
+    pixels[point_idx, 2] = ((1 - ratio) * 255).astype(int)
+    pixels[point_idx, 3] = OVERLAY_ALPHA
+    return image
+
+
+def heatmap_overlay(heatmap_file):
+    # The whole heatmap as one PNG (data URL) with its bounds, rendered once
+    # per heatmap file and kept on disk
+    heatmap_gdf = load_heatmap(heatmap_file)
+    west, south, east, north = heatmap_gdf.total_bounds.tolist()
+    overlay_path = _overlay_path(heatmap_digest(heatmap_file))
+    if not os.path.exists(overlay_path):
+        lons, lats = _pixel_centers((west, south, east, north))
+        png = write_png(
+            rasterize(heatmap_gdf, np.unique(heatmap_gdf["LICZBA"]), lons, lats)
+        )
+        os.makedirs(os.path.dirname(overlay_path), exist_ok=True)
+        tmp_path = f"{overlay_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(png)
+        os.replace(tmp_path, overlay_path)
+    with open(overlay_path, "rb") as f:
+        image = "data:image/png;base64," + base64.b64encode(f.read()).decode()
+    return image, [[south, west], [north, east]]
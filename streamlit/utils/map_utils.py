@@ -1,6 +1,7 @@
 import folium
 import streamlit as st
-import osmnx as ox
+from utils.districts import get_district_geodataframe
+from utils.drawing import draw_district
 
 
 def initialize_map(location):
@@ -13,7 +14,6 @@ def initialize_map(location):
     )
 
 
-def add_district_boundaries(map_object, location_name):
-    district = ox.geocode_to_gdf(location_name)
-    folium.GeoJson(district).add_to(map_object)
-    return map_object
+def add_district_boundaries(map_object, location_name, admin_level=None):
+    district = get_district_geodataframe(location_name, admin_level)
+    return draw_district(map_object, district)
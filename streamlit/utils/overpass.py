@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from datetime import timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Client for the Overpass API: one session with pooled connections for the
+# whole process, timeouts, retries with exponential backoff on rate limiting
+# and server errors, and a persistent cache of the responses by their query.
+# The endpoint is OVERPASS_URL, so a local server can stand in for it
+
+# Seconds to wait for the connection, the read timeout is the query timeout
+CONNECT_TIMEOUT = 10
+# Retries of a failed request, waiting 2, 4, 8... seconds in between
+RETRIES = 4
+BACKOFF_FACTOR = 2
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Connections kept open to the endpoint
+POOL_SIZE = 8
+
+OVERPASS_URL = os.environ.get(
+    "OVERPASS_URL", "https://overpass-api.de/api/interpreter"
+)
+# Seconds the server may spend on a query
+OVERPASS_TIMEOUT = int(os.environ.get("OVERPASS_TIMEOUT", 180))
+OVERPASS_CACHE_DIR = os.environ.get(
+    "OVERPASS_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "overpass"),
+)
+OVERPASS_TTL_DAYS = int(os.environ.get("OVERPASS_TTL_DAYS", 7))
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def quote(value):
+    # Overpass QL string literal, so that names cannot break the query
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{value}"'
+
+
+def _get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=RETRIES,
+                backoff_factor=BACKOFF_FACTOR,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=("GET", "POST"),
+                respect_retry_after_header=True,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["User-Agent"] = "age_friendly"
+            _session = session
+        return _session
+
+
+def _ttl():
+    return timedelta(days=OVERPASS_TTL_DAYS)
+
+
+def _cache_path(query):
+    key = f"{OVERPASS_URL}\n{query}"
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+    return os.path.join(OVERPASS_CACHE_DIR, f"{digest}.json")
+
+
+def _read_response(path):
+    if not os.path.exists(path):
+        return None
+    if time.time() - os.path.getmtime(path) > _ttl().total_seconds():
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_response(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def overpass_query(body, refresh=False):
+    # JSON response of an Overpass QL query without its header line, which
+    # is added here. Cached responses are used while they are fresh
+    timeout = OVERPASS_TIMEOUT
+    query = f"[out:json][timeout:{timeout}];\n{body}"
+    path = _cache_path(query)
+    if not refresh:
+        data = _read_response(path)
+        if data is not None:
+            return data
+
+    response = _get_session().post(
+        OVERPASS_URL,
+        data={"data": query},
+        # The server gives up after `timeout` seconds, allow for the transfer
+        timeout=(CONNECT_TIMEOUT, timeout + 30),
+    )
+    response.raise_for_status()
+    data = response.json()
+    # Queries that ran out of time or memory are answered with partial data
+    # and a remark, which must not be cached
+    if "runtime error" in data.get("remark", ""):
+        raise RuntimeError(f"Overpass query failed: {data['remark']}")
+    _write_response(path, data)
+    return data
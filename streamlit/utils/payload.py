@@ -0,0 +1,303 @@
+import json
+import numpy as np
+import shapely
+
+# Geometries sent to the browser are only as detailed as the map can show:
+# they are simplified to a fraction of a pixel at the zoom level they are
+# prepared for and their coordinates are rounded to match
+
+# Width of the map tiles in pixels
+TILE_SIZE = 256
+# Largest deviation of a simplified geometry from the original, in pixels
+PIXEL_TOLERANCE = 0.5
+# Largest rounding error of a coordinate, in pixels
+PIXEL_PRECISION = 0.25
+
+# Zoom levels the layers are prepared for
+SIDEWALKS_ZOOM = 18
+DISTRICT_ZOOM = 17
+HEATMAP_ZOOM = 16
+
+
+def pixel_size(zoom):
+    # Width of one pixel in degrees of longitude
+    return 360 / (TILE_SIZE * 2**zoom)
+
+
+def zoom_tolerance(zoom):
+    return PIXEL_TOLERANCE * pixel_size(zoom)
+
+
+def zoom_decimals(zoom):
+    # Fewest decimals that keep the rounding error below the precision
+    return int(np.ceil(-np.log10(2 * PIXEL_PRECISION * pixel_size(zoom))))
+
+
+def _is_polygonal(geometries):
+    kinds = shapely.get_type_id(geometries)
+    return (kinds == shapely.GeometryType.POLYGON) | (
+        kinds == shapely.GeometryType.MULTIPOLYGON
+    )
+
+
+def _repair(geometry):
+    # Valid version of a polygon, without the lines and points left over from
+    # parts that collapsed
+    repaired = shapely.make_valid(geometry)
+    if shapely.get_type_id(repaired) != shapely.GeometryType.GEOMETRYCOLLECTION:
+        return repaired
+    parts = shapely.get_parts(shapely.get_parts(repaired))
+    polygons = parts[_is_polygonal(parts)]
+    if len(polygons) == 1:
+        return polygons[0]
+    return shapely.multipolygons(polygons) if len(polygons) else shapely.Polygon()
+
+
+def reduce_geometries(geometries, zoom):
+    # Simplify and quantize geometries in WGS84 for the given zoom level. Each
+    # geometry is simplified on its own, so boundaries shared by neighbours
+    # may no longer match (topology() keeps them shared). Polygons made
+    # invalid by the rounding are repaired
+    geometries = shapely.simplify(
+        np.asarray(geometries), zoom_tolerance(zoom), preserve_topology=True
+    )
+    decimals = zoom_decimals(zoom)
+    geometries = shapely.transform(geometries, lambda coords: np.round(coords, decimals))
+    invalid = _is_polygonal(geometries) & ~shapely.is_valid(geometries)
+    geometries[invalid] = [_repair(geometry) for geometry in geometries[invalid]]
+    return geometries
+
+
+def feature_collection(geometries, properties, zoom=None):
+    # GeoJSON FeatureCollection of shapely geometries (in WGS84) with one
+    # dictionary of properties per geometry
+    if zoom is not None:
+        geometries = reduce_geometries(geometries, zoom)
+    geometries = shapely.to_geojson(np.asarray(geometries))
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "properties": props,
+                "geometry": json.loads(geometry) if geometry else None,
+            }
+            for props, geometry in zip(properties, geometries)
+        ],
+    }
+
+
+def _sequences(geometry):
+    # Coordinate sequences of a geometry, grouped by part (lines, or rings of
+    # polygons), and whether they are rings
+    if geometry is None or shapely.is_empty(geometry):
+        return [], False
+    kind = shapely.get_type_id(geometry)
+    if kind in (shapely.GeometryType.LINESTRING, shapely.GeometryType.MULTILINESTRING):
+        lines = shapely.get_parts(geometry)
+        return [[shapely.get_coordinates(line)] for line in lines], False
+    if kind in (shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON):
+        return [
+            [shapely.get_coordinates(ring) for ring in shapely.get_rings(polygon)]
+            for polygon in shapely.get_parts(geometry)
+        ], True
+    raise ValueError(f"TopoJSON encoding of {geometry.geom_type} is not supported")
+
+
+def _simplify_arc(arc, tolerance):
+    # Arcs keep their ends, which are junctions, and closed arcs stay rings
+    if len(arc) >= 4 and (arc[0] == arc[-1]).all():
+        line = shapely.linearrings(arc)
+    elif len(arc) > 2:
+        line = shapely.linestrings(arc)
+    else:
+        return arc
+    line = shapely.simplify(line, tolerance, preserve_topology=True)
+    return shapely.get_coordinates(line).astype(np.int64)
+
+
+def _join(arcs, refs):
+    # Coordinates of a line or ring made of the referenced arcs
+    parts = [arcs[ref] if ref >= 0 else arcs[~ref][::-1] for ref in refs]
+    return np.concatenate([parts[0]] + [part[1:] for part in parts[1:]])
+
+
+def _decode_polygons(arcs, arc_refs):
+    # Polygons of the arc references of a TopoJSON (multi)polygon, and
+    # whether none of their rings collapsed to fewer than four points
+    polygons, complete = [], True
+    for refs in arc_refs:
+        rings = [_join(arcs, ring) for ring in refs]
+        complete = complete and all(len(ring) >= 4 for ring in rings)
+        if len(rings[0]) >= 4:
+            holes = [ring for ring in rings[1:] if len(ring) >= 4]
+            polygons.append(shapely.Polygon(rings[0], holes))
+    return shapely.MultiPolygon(polygons), complete
+
+
+def _topology_object(geometry, arcs, props):
+    kind = shapely.get_type_id(geometry) if geometry is not None else None
+    if not arcs:
+        return {"type": None, "properties": props}
+    if kind == shapely.GeometryType.LINESTRING:
+        return {"type": "LineString", "arcs": arcs[0][0], "properties": props}
+    if kind == shapely.GeometryType.MULTILINESTRING:
+        arcs = [part[0] for part in arcs]
+        return {"type": "MultiLineString", "arcs": arcs, "properties": props}
+    if kind == shapely.GeometryType.POLYGON:
+        return {"type": "Polygon", "arcs": arcs[0], "properties": props}
+    return {"type": "MultiPolygon", "arcs": arcs, "properties": props}
+
+
+def topology(geometries, properties, zoom, name="features"):
+    # TopoJSON of linear or polygonal geometries (in WGS84): boundaries shared
+    # by neighbouring geometries are stored once as arcs, coordinates are
+    # quantized to integers and delta-encoded. The arcs are simplified rather
+    # than the geometries, so that neighbours still share their boundaries
+    geometries = np.asarray(geometries)
+    scale = 10.0 ** -zoom_decimals(zoom)
+    geometry_parts = [_sequences(geometry) for geometry in geometries]
+    sequences = [
+        (coords, ring)
+        for parts, ring in geometry_parts
+        for part in parts
+        for coords in part
+    ]
+    if not sequences:
+        return {
+            "type": "Topology",
+            "objects": {name: {"type": "GeometryCollection", "geometries": []}},
+            "arcs": [],
+        }
+
+    # Integer grid coordinates and an id for every distinct point
+    coords = np.concatenate([coords for coords, _ in sequences])
+    translate = coords.min(axis=0)
+    grid = np.round((coords - translate) / scale).astype(np.int64)
+    points, point_ids = np.unique(grid, axis=0, return_inverse=True)
+    ends = np.cumsum([len(coords) for coords, _ in sequences])
+    sequence_ids = np.split(point_ids.ravel(), ends[:-1])
+
+    # Drop the closing point of rings and points repeated by the rounding
+    cleaned = []
+    for ids, (_, ring) in zip(sequence_ids, sequences):
+        if ring:
+            ids = ids[:-1]
+        keep = np.ones(len(ids), dtype=bool)
+        keep[1:] = ids[1:] != ids[:-1]
+        if ring and len(ids) > 1:
+            keep[0] = ids[0] != ids[-1]
+        cleaned.append((ids[keep], ring))
+
+    # Junctions are the points where sequences meet or part: points reached
+    # from different neighbours in different places, and the ends of lines
+    occurrence, previous, following = [], [], []
+    for ids, ring in cleaned:
+        if ring and len(ids) > 1:
+            occurrence.append(ids)
+            previous.append(np.roll(ids, 1))
+            following.append(np.roll(ids, -1))
+        elif len(ids) > 1:
+            occurrence.append(ids[1:-1])
+            previous.append(ids[:-2])
+            following.append(ids[2:])
+    junction = np.zeros(len(points), dtype=bool)
+    if occurrence:
+        occurrence = np.concatenate(occurrence)
+        previous, following = np.concatenate(previous), np.concatenate(following)
+        neighbours = np.unique(
+            np.column_stack(
+                [
+                    occurrence,
+                    np.minimum(previous, following),
+                    np.maximum(previous, following),
+                ]
+            ),
+            axis=0,
+        )
+        junction = np.bincount(neighbours[:, 0], minlength=len(points)) > 1
+    for ids, ring in cleaned:
+        if not ring and len(ids):
+            junction[[ids[0], ids[-1]]] = True
+
+    # Cut the sequences at the junctions and store every arc once, an arc
+    # used in the opposite direction is referenced as ~index
+    arcs, arc_index = [], {}
+
+    def add_arc(ids):
+        key = tuple(ids.tolist())
+        if key[::-1] in arc_index:
+            return ~arc_index[key[::-1]]
+        if key not in arc_index:
+            arc_index[key] = len(arcs)
+            arcs.append(ids)
+        return arc_index[key]
+
+    def cut(ids, ring):
+        if len(ids) == 0:
+            return []
+        cuts = np.flatnonzero(junction[ids])
+        if not ring:
+            if len(ids) == 1:
+                return [add_arc(ids)]
+            return [add_arc(ids[a : b + 1]) for a, b in zip(cuts[:-1], cuts[1:])]
+        if len(cuts) == 0:
+            # A ring without junctions starts at its lowest point so that the
+            # same ring is recognised whatever its original starting point
+            ids = np.roll(ids, -int(np.argmin(ids)))
+            return [add_arc(np.append(ids, ids[0]))]
+        ids = np.roll(ids, -cuts[0])
+        ids = np.append(ids, ids[0])
+        cuts = np.append(cuts - cuts[0], len(ids) - 1)
+        return [add_arc(ids[a : b + 1]) for a, b in zip(cuts[:-1], cuts[1:])]
+
+    objects = []
+    sequence = iter(cleaned)
+    for geometry, (parts, _), props in zip(geometries, geometry_parts, properties):
+        arc_refs = [[cut(*next(sequence)) for _ in part] for part in parts]
+        objects.append(_topology_object(geometry, arc_refs, props))
+
+    # Every arc is simplified once on the grid, so that neighbours still
+    # share their boundaries
+    tolerance = zoom_tolerance(zoom) / scale
+    arcs = [_simplify_arc(points[ids], tolerance) for ids in arcs]
+
+    # Polygons made invalid by the rounding or the simplification are
+    # repaired and get arcs of their own
+    for obj in objects:
+        if obj["type"] not in ("Polygon", "MultiPolygon"):
+            continue
+        arc_refs = obj["arcs"] if obj["type"] == "MultiPolygon" else [obj["arcs"]]
+        polygons, complete = _decode_polygons(arcs, arc_refs)
+        if complete and polygons.is_valid:
+            continue
+        repaired = shapely.set_precision(_repair(polygons), 1)
+        arc_refs = []
+        for polygon in shapely.get_parts(repaired):
+            refs = []
+            for ring in shapely.get_rings(polygon):
+                refs.append([len(arcs)])
+                arcs.append(shapely.get_coordinates(ring).astype(np.int64))
+            arc_refs.append(refs)
+        obj.pop("arcs")
+        if not arc_refs:
+            obj["type"] = None
+        elif len(arc_refs) == 1:
+            obj.update(type="Polygon", arcs=arc_refs[0])
+        else:
+            obj.update(type="MultiPolygon", arcs=arc_refs)
+
+    # The first point of an arc is absolute, the others are offsets from the
+    # previous point
+    encoded_arcs = []
+    for arc in arcs:
+        arc = arc.copy()
+        arc[1:] = arc[1:] - arc[:-1]
+        encoded_arcs.append(arc.tolist())
+
+    return {
+        "type": "Topology",
+        "transform": {"scale": [scale, scale], "translate": translate.tolist()},
+        "objects": {name: {"type": "GeometryCollection", "geometries": objects}},
+        "arcs": encoded_arcs,
+    }
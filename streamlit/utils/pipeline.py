@@ -0,0 +1,174 @@
+import os
+from collections import namedtuple
+
+import geopandas as gpd
+import streamlit as st
+from utils.benches_sidewalks import (
+    assign_benches_to_sidewalks,
+    get_benches,
+    get_sidewalks,
+)
+from utils.classification import classify_sidewalks, compute_gap_profiles
+from utils.districts import get_district_geodataframe
+from utils.heatmap_data import file_digest
+from utils.payload import SIDEWALKS_ZOOM, reduce_geometries
+from utils.projection import get_metric_crs, to_crs, to_wgs84
+from utils.simulation import add_optimized_benches, simulate_budget_curve
+from utils.statistics import get_basic_statistics
+
+# The analysis runs in stages that are cached separately, so that a widget
+# only repeats the stages that depend on it. Every stage is keyed by cheap
+# fingerprints of its inputs (arguments starting with "_" are not hashed) and
+# keeps its results in the resource cache, which hands out the same objects
+# instead of copies: stages copy what they change and the results must be
+# treated as read-only
+
+# Number of results kept by every stage
+STAGE_ENTRIES = 16
+
+# District, sidewalks and benches in the metric CRS, with the benches assigned
+# to the sidewalks and their gap profiles
+Inputs = namedtuple("Inputs", ["district", "sidewalks", "benches", "profiles"])
+
+# Classified sidewalks and benches in WGS84 with the geometries reduced for the
+# map, and the statistics
+Analysis = namedtuple(
+    "Analysis",
+    [
+        "district",
+        "sidewalks",
+        "benches",
+        "profiles",
+        "street_stats",
+        "general_stats",
+        "budget_curve",
+    ],
+)
+
+
+def file_fingerprint(file):
+    # Files in the static folder are identified by their modification time and
+    # size, uploaded files by their content
+    if file is None:
+        return None
+    if isinstance(file, (str, os.PathLike)):
+        stat = os.stat(file)
+        return f"{os.fspath(file)}:{stat.st_mtime_ns}:{stat.st_size}"
+    return file_digest(file.getvalue())
+
+
+@st.cache_resource(max_entries=STAGE_ENTRIES, show_spinner=False)
+def load_inputs(
+    location_name, highway_types, benches_key, admin_level, _benches_file, _refresh=False
+):
+    district = get_district_geodataframe(location_name, admin_level, refresh=_refresh)
+    sidewalks_gdf = get_sidewalks(
+        location_name, list(highway_types), admin_level, refresh=_refresh
+    )
+    benches_gdf = get_benches(
+        location_name, district, _benches_file, admin_level, refresh=_refresh
+    )
+    # Run the analysis in metres
+    metric_crs = get_metric_crs(district)
+    district = to_crs(district, metric_crs)
+    sidewalks_gdf = to_crs(sidewalks_gdf, metric_crs)
+    benches_gdf = to_crs(benches_gdf, metric_crs)
+    sidewalks_gdf = assign_benches_to_sidewalks(sidewalks_gdf, benches_gdf)
+    return Inputs(district, sidewalks_gdf, benches_gdf, compute_gap_profiles(sidewalks_gdf))
+
+
+@st.cache_resource(max_entries=STAGE_ENTRIES, show_spinner=False)
+def simulate(
+    inputs_key, num_benches, good_distance, okay_distance, bench_cost, _inputs
+):
+    # Place the benches the budget allows and record the budget curve
+    budget_curve = simulate_budget_curve(
+        _inputs.sidewalks,
+        num_benches,
+        good_distance,
+        okay_distance,
+        bench_cost=bench_cost,
+        profiles=_inputs.profiles,
+    )
+    benches_gdf, sidewalks_gdf = add_optimized_benches(
+        _inputs.benches, _inputs.sidewalks, num_benches, good_distance, _inputs.profiles
+    )
+    inputs = Inputs(
+        _inputs.district, sidewalks_gdf, benches_gdf, compute_gap_profiles(sidewalks_gdf)
+    )
+    return inputs, budget_curve
+
+
+@st.cache_resource(max_entries=STAGE_ENTRIES, show_spinner=False)
+def classify(inputs_key, good_distance, okay_distance, heatmap_key, _inputs, _heatmap_file):
+    sidewalks_class = classify_sidewalks(
+        _inputs.sidewalks.copy(), good_distance, okay_distance, profiles=_inputs.profiles
+    )
+    street_stats, general_stats = get_basic_statistics(
+        sidewalks_class.copy(), _inputs.benches, _inputs.district, _heatmap_file
+    )
+    # Everything the map needs, so that the display options only restyle it
+    sidewalks_class = to_wgs84(sidewalks_class)
+    sidewalks_class = sidewalks_class.set_geometry(
+        gpd.GeoSeries(
+            reduce_geometries(sidewalks_class.geometry.values, SIDEWALKS_ZOOM),
+            index=sidewalks_class.index,
+            crs=sidewalks_class.crs,
+        )
+    )
+    return sidewalks_class, to_wgs84(_inputs.benches), street_stats, general_stats
+
+
+def clear_pipeline():
+    for stage in (load_inputs, simulate, classify):
+        stage.clear()
+
+
+def run_pipeline(
+    location_name,
+    highway_types,
+    benches_file,
+    heatmap_file,
+    good_distance,
+    okay_distance,
+    num_benches=None,
+    bench_cost=None,
+    admin_level=None,
+    refresh=False,
+):
+    if refresh:
+        clear_pipeline()
+
+    inputs_key = (
+        location_name,
+        tuple(highway_types),
+        file_fingerprint(benches_file),
+        admin_level,
+    )
+    inputs = load_inputs(*inputs_key, benches_file, refresh)
+
+    budget_curve = None
+    if num_benches is not None:
+        inputs, budget_curve = simulate(
+            inputs_key, num_benches, good_distance, okay_distance, bench_cost, inputs
+        )
+        # Later stages work on the simulated benches
+        inputs_key += (num_benches, good_distance, okay_distance, bench_cost)
+
+    sidewalks_class, benches_gdf, street_stats, general_stats = classify(
+        inputs_key,
+        good_distance,
+        okay_distance,
+        file_fingerprint(heatmap_file),
+        inputs,
+        heatmap_file,
+    )
+    return Analysis(
+        inputs.district,
+        sidewalks_class,
+        benches_gdf,
+        inputs.profiles,
+        street_stats,
+        general_stats,
+        budget_curve,
+    )
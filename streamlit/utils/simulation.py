@@ -1,100 +1,222 @@
+import heapq
 import geopandas as gpd
 import numpy as np
 import pandas as pd
-from shapely.geometry import Point
-from utils.classification import classify_sidewalks
+import shapely
+from utils.classification import benches_needed, compute_gap_profiles
+
+
+# Kinds of gaps along a sidewalk: between two benches, between the start of
+# the sidewalk and the first bench, between the last bench and the end, and
+# a sidewalk without any benches
+INNER, START, END, EMPTY = range(4)
+
+
+def _gap_priority(kind, start, end):
+    # Distance from the worst placed point of the gap to the nearest bench
+    if kind == INNER:
+        return (end - start) / 2
+    return end - start
+
+
+def _gap_is_covered(kind, start, end, distance):
+    if kind == INNER:
+        return end - start <= distance
+    if kind == EMPTY:
+        return end <= start
+    return end - start <= distance / 2
+
+
+def _split_gap(kind, start, end):
+    # Position of the new bench and the gaps it leaves behind
+    if kind == INNER:
+        position = (start + end) / 2
+        return position, [(INNER, start, position), (INNER, position, end)]
+    if kind == START:
+        position = start + (end - start) / 3
+        return position, [(START, start, position), (INNER, position, end)]
+    if kind == END:
+        position = end - (end - start) / 3
+        return position, [(INNER, start, position), (END, position, end)]
+    position = (start + end) / 2
+    return position, [(START, start, position), (END, position, end)]
+
+
+def _initial_gaps(profiles):
+    gaps = []
+    street, positions = profiles.bench_street, profiles.bench_positions
+    for i in range(len(positions)):
+        is_first = i == 0 or street[i - 1] != street[i]
+        is_last = i == len(positions) - 1 or street[i + 1] != street[i]
+        if is_first:
+            gaps.append((street[i], START, 0.0, positions[i]))
+        if is_last:
+            gaps.append((street[i], END, positions[i], profiles.lengths[street[i]]))
+        else:
+            gaps.append((street[i], INNER, positions[i], positions[i + 1]))
+    for i in np.flatnonzero(profiles.counts == 0):
+        gaps.append((i, EMPTY, 0.0, profiles.lengths[i]))
+    return gaps
+
+
+def greedy_placements(profiles, good_street_value):
+    # Greedily place benches in the gap that is furthest from any bench. Every
+    # gap is independent of the others, so after a placement only the two new
+    # gaps are pushed onto the heap. Yields (street, position, old gap, new gaps)
+    heap = [
+        (-_gap_priority(kind, start, end), street, kind, start, end)
+        for street, kind, start, end in _initial_gaps(profiles)
+    ]
+    heapq.heapify(heap)
+    while heap:
+        _, street, kind, start, end = heapq.heappop(heap)
+        # Gaps that are already short enough don't need a bench
+        if _gap_is_covered(kind, start, end, good_street_value):
+            continue
+        position, new_gaps = _split_gap(kind, start, end)
+        for gap in new_gaps:
+            heapq.heappush(heap, (-_gap_priority(*gap), street, *gap))
+        yield street, position, (kind, start, end), new_gaps
 
 
 def add_optimized_benches(
-    benches_gdf, sidewalks_gdf, num_benches, good_street_value, tolerance_factor=2
+    benches_gdf,
+    sidewalks_gdf,
+    num_benches,
+    good_street_value,
+    profiles=None,
+    tolerance=1.1,
 ):
-
-    # Generate candidate places for each street
-    def generate_candidate_bench_placements(street):
-        street_geometry = street["geometry"]
-        street_length = street_geometry.length
-        # Double the number of candidate points
-        num_candidates = int(street_length // good_street_value) * tolerance_factor
-
-        # Generate candidate points at intervals along the street geometry
-        candidate_points = [
-            street_geometry.interpolate(i * (street_length / num_candidates))
-            for i in range(1, num_candidates + 1)
-        ]
-
-        # Calculate initial distances for each candidate
-        distances = []
-        for candidate in candidate_points:
-            if street["benches"]:
-                # Distance to nearest bench on the same street
-                min_distance = min(
-                    candidate.distance(bench) for bench in street["benches"]
-                )
-            else:
-                # If no benches on the street, use the distance to the nearest bench in general
-                min_distance = min(
-                    candidate.distance(bench) for bench in benches_gdf.geometry
-                )
-            distances.append((candidate, min_distance))
-
-        return distances
-
-    # Precompute all candidate points and distances for each street
-    street_candidates = {}
-    for _, street in sidewalks_gdf.iterrows():
-        street_candidates[street.name] = generate_candidate_bench_placements(street)
-
-    benches_to_add = []
-    while num_benches > 0 and any(street_candidates.values()):
-        # Find the candidate with the maximum distance to the nearest existing bench on the same street
-        max_distance = 0
-        best_candidate = None
-        best_street = None
-
-        for street_id, candidates in street_candidates.items():
-            if not candidates:
-                continue
-            candidate, distance = max(candidates, key=lambda x: x[1])
-            if distance > max_distance:
-                max_distance = distance
-                best_candidate = candidate
-                best_street = street_id
-
-        if best_candidate is None:
-            break  # No more valid candidates
-
-        # Place the selected bench
-        benches_to_add.append(best_candidate)
-        num_benches -= 1
-
-        # Update the street's list of benches
-        sidewalks_gdf.at[best_street, "benches"].append(best_candidate)
-
-        # Reclassify only the affected street to check if it meets the "good" status
-        affected_street = sidewalks_gdf.loc[[best_street]]
-        sidewalks_gdf.update(
-            classify_sidewalks(affected_street, good_street_value, good_street_value)
-        )
-
-        # Update only the distances for candidates on this street
-        updated_candidates = []
-        for candidate, _ in street_candidates[best_street]:
-            # Calculate distance to the nearest bench on the same street
-            distance = min(
-                candidate.distance(bench)
-                for bench in sidewalks_gdf.at[best_street, "benches"]
-            )
-            updated_candidates.append((candidate, distance))
-
-        # Only keep candidates with a positive distance
-        street_candidates[best_street] = [c for c in updated_candidates if c[1] > 0]
-
-    # Convert the added benches to a GeoDataFrame and merge with existing benches
-    if benches_to_add:
+    # Benches with the simulated ones and the sidewalks with every simulated
+    # bench added to the street it was placed on only, as in
+    # simulate_budget_curve, so that the map matches the end of the curve
+    if profiles is None:
+        profiles = compute_gap_profiles(sidewalks_gdf)
+
+    # Place benches until the gaps are covered as classify_sidewalks sees them
+    placements = []
+    for placement in greedy_placements(profiles, good_street_value * tolerance):
+        if len(placements) >= num_benches:
+            break
+        placements.append(placement[:2])
+
+    # Convert the positions along the sidewalks to points
+    sidewalks_gdf = sidewalks_gdf.copy()
+    if placements:
+        streets, positions = np.array(placements).T
+        streets = streets.astype(int)
+        lines = np.asarray(sidewalks_gdf.geometry.values)[streets]
+        points = shapely.line_interpolate_point(lines, positions)
         new_benches_gdf = gpd.GeoDataFrame(
-            geometry=benches_to_add, crs=sidewalks_gdf.crs
+            {"amenity": "simulated"},
+            index=range(len(placements)),
+            geometry=points,
+            crs=sidewalks_gdf.crs,
         )
         benches_gdf = pd.concat([benches_gdf, new_benches_gdf], ignore_index=True)
-        benches_gdf = benches_gdf.drop_duplicates(subset=['geometry'])
 
-    return benches_gdf
+        # New lists, the benches of the given sidewalks stay as they are
+        placed = pd.Series(list(points)).groupby(streets).agg(list)
+        sidewalks_gdf["benches"] = [
+            benches + placed.get(i, [])
+            for i, benches in enumerate(sidewalks_gdf["benches"])
+        ]
+
+    return benches_gdf, sidewalks_gdf
+
+def _gap_benches_needed(kind, start, end, distance):
+    # Same rules as benches_needed in utils.classification, for a single gap
+    if kind == INNER:
+        return max(int(np.ceil((end - start) / distance)) - 1, 0)
+    if kind == EMPTY:
+        return int(np.ceil((end - start) / distance))
+    return max(int(np.ceil((end - start) / distance - 0.5)), 0)
+
+
+def simulate_budget_curve(
+    sidewalks_gdf,
+    num_benches,
+    good_street_value,
+    okay_street_value,
+    bench_cost=None,
+    profiles=None,
+    tolerance=1.1,
+):
+    # Run the greedy placement once and record the statistics after every
+    # placed bench, so that the whole friendliness-vs-budget curve is known
+    if profiles is None:
+        profiles = compute_gap_profiles(sidewalks_gdf)
+
+    # Statistics use the same tolerance as classify_sidewalks
+    good_value = good_street_value * tolerance
+    okay_value = okay_street_value * tolerance
+    # Streets are weighted by the same lengths as in get_basic_statistics
+    lengths = sidewalks_gdf["length"].to_numpy(dtype=float)
+    total_length = lengths.sum() if lengths.sum() > 0 else 1
+
+    counts = profiles.counts.astype(float)
+    to_good = benches_needed(profiles, good_value).astype(float)
+    to_okay = benches_needed(profiles, okay_value).astype(float)
+
+    def friendliness(street):
+        benches = counts[street] + to_good[street]
+        return counts[street] / benches if benches > 0 else 0
+
+    def street_class(street):
+        if to_good[street] == 0:
+            return "good"
+        return "okay" if to_okay[street] == 0 else "bad"
+
+    # Length-weighted friendliness (as in get_basic_statistics) and class lengths
+    score = sum(friendliness(i) * lengths[i] for i in range(len(lengths)))
+    class_lengths = {"good": 0.0, "okay": 0.0, "bad": 0.0}
+    for i in range(len(lengths)):
+        class_lengths[street_class(i)] += lengths[i]
+
+    def record(benches, street=None, position=None):
+        return {
+            "benches": benches,
+            "cost": benches * bench_cost if bench_cost else None,
+            "friendliness": score / total_length * 100,
+            "good_length_km": class_lengths["good"] / 1000,
+            "okay_length_km": class_lengths["okay"] / 1000,
+            "bad_length_km": class_lengths["bad"] / 1000,
+            "street": street,
+            "position": position,
+        }
+
+    rows = [record(0)]
+    for street, position, old_gap, new_gaps in greedy_placements(profiles, good_value):
+        if len(rows) > num_benches:
+            break
+
+        # Only the touched street changes
+        score -= friendliness(street) * lengths[street]
+        class_lengths[street_class(street)] -= lengths[street]
+        counts[street] += 1
+        for distance, needed in [(good_value, to_good), (okay_value, to_okay)]:
+            needed[street] += sum(
+                _gap_benches_needed(*gap, distance) for gap in new_gaps
+            ) - _gap_benches_needed(*old_gap, distance)
+        score += friendliness(street) * lengths[street]
+        class_lengths[street_class(street)] += lengths[street]
+
+        rows.append(record(len(rows), street, position))
+
+    curve = pd.DataFrame(rows)
+
+    # Placement order as coordinates of the new benches
+    placed = curve["street"].notna()
+    lines = np.asarray(sidewalks_gdf.geometry.values)[
+        curve.loc[placed, "street"].astype(int)
+    ]
+    points = gpd.GeoSeries(
+        shapely.line_interpolate_point(lines, curve.loc[placed, "position"].to_numpy(float)),
+        crs=sidewalks_gdf.crs,
+    ).to_crs(epsg=4326)
+    curve.loc[placed, "longitude"] = points.x.to_numpy()
+    curve.loc[placed, "latitude"] = points.y.to_numpy()
+    curve["street"] = curve["street"].map(
+        lambda i: None if pd.isna(i) else str(sidewalks_gdf.index[int(i)])
+    )
+    return curve.drop(columns="position")
@@ -2,7 +2,14 @@ import pandas as pd
 import numpy as np
 import geopandas as gpd
 import os
-from shapely.geometry import MultiLineString, LineString
+import shapely
+from scipy.spatial import cKDTree
+from utils.heatmap_data import load_heatmap
+from utils.projection import to_crs, to_wgs84
+
+# Spacing (in metres) of the points along the sidewalks used for the
+# sidewalk-to-bench distances
+SAMPLE_SPACING = 10
 
 
 def calculate_single_street_friendliness(sidewalk):
@@ -14,81 +21,46 @@ def calculate_single_street_friendliness(sidewalk):
         return 0
 
 
-def calculate_average_nearest_bench_distance(sidewalks_gdf):
-
-    if sidewalks_gdf.crs.to_epsg() != 3857:
-        sidewalks_gdf = sidewalks_gdf.to_crs(epsg=3857)
-
-    nearest_distances = []  # Collect all minimum distances across all benches
-    avg_distances = []  # Collect per-sidewalk average distances
-    max_distances = []  # Collect per-sidewalk maximum distances
-
-    for _, sidewalk in sidewalks_gdf.iterrows():
-        benches = sidewalk.benches
-        if len(benches) < 2:
-            continue
-
-        sidewalk_distances = []
-        for i, bench in enumerate(benches):
-            distances = [
-                bench.distance(other_bench)
-                for j, other_bench in enumerate(benches)
-                if i != j
-            ]
-            if distances:
-                min_distance = min(distances) * 111320  # Convert to meters
-                sidewalk_distances.append(min_distance)
-                nearest_distances.append(
-                    min_distance
-                )  # Collecting all minimum distances
-
-        # Compute sidewalk-specific statistics if distances were found
-        if sidewalk_distances:
-            avg_distances.append(
-                np.mean(sidewalk_distances)
-            )  # Average for each sidewalk
-            max_distances.append(
-                np.max(sidewalk_distances)
-            )  # Maximum for each sidewalk
-
-    avg_of_nearest_distances = np.mean(nearest_distances) if nearest_distances else 0
-    avg_of_avg_distances = np.mean(avg_distances) if avg_distances else 0
-    avg_of_max_distances = np.mean(max_distances) if max_distances else 0
-
-    return avg_of_nearest_distances, avg_of_max_distances, avg_of_avg_distances
-
-
-def parse_multilinestring(multilinestring_str):
-    # Remove the 'MultiLineString ((' and '))' from the string
-    multilinestring_str = multilinestring_str.replace("MultiLineString ((", "").replace(
-        "))", ""
-    )
-    linestrings = multilinestring_str.split("), (")
-    line_coords = []
-    for line in linestrings:
-        coords = []
-        for coord in line.split(", "):
-            try:
-                # Split coordinate into x and y
-                x_str, y_str = coord.strip().split()
-                x = float(x_str)
-                y = float(y_str)
-                coords.append((x, y))
-            except ValueError:
-                # Skip invalid coordinate pairs
-                continue
-        # Only add lines with at least two valid coordinates
-        if len(coords) >= 2:
-            line_coords.append(coords)
-    # Check if we have at least one valid linestring
-    if line_coords:
-        try:
-            return MultiLineString([LineString(coords) for coords in line_coords])
-        except ValueError as e:
-            print(f"Error creating MultiLineString: {e}")
-            return None
+def _distance_summary(distances):
+    if len(distances) == 0:
+        return {"mean": "N/A", "median": "N/A", "p90": "N/A", "max": "N/A"}
+    return {
+        "mean": float(np.mean(distances)),
+        "median": float(np.median(distances)),
+        "p90": float(np.percentile(distances, 90)),
+        "max": float(np.max(distances)),
+    }
+
+
+def calculate_nearest_bench_distances(sidewalks_gdf, benches_gdf):
+    # Nearest-neighbour distances (in metres) from every bench to the closest
+    # other bench and from points every SAMPLE_SPACING metres along the
+    # sidewalks to the closest bench, on any street
+    if len(benches_gdf) == 0:
+        return _distance_summary([]), _distance_summary([])
+
+    benches = to_crs(benches_gdf, sidewalks_gdf.crs).geometry.values
+    bench_coords = shapely.get_coordinates(shapely.centroid(benches))
+    tree = cKDTree(bench_coords)
+
+    # The closest point to every bench is the bench itself
+    if len(bench_coords) > 1:
+        bench_distances = tree.query(bench_coords, k=2)[0][:, 1]
     else:
-        return None  # Return None if no valid lines found
+        bench_distances = []
+
+    lines = np.asarray(sidewalks_gdf.geometry.values)
+    lengths = shapely.length(lines)
+    counts = np.floor(lengths / SAMPLE_SPACING).astype(int) + 1
+    street_idx = np.repeat(np.arange(len(lines)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    samples = shapely.line_interpolate_point(
+        lines[street_idx], offsets * SAMPLE_SPACING
+    )
+    sidewalk_distances = tree.query(shapely.get_coordinates(samples))[0]
+
+    return _distance_summary(bench_distances), _distance_summary(sidewalk_distances)
+
 
 def calculate_benches_needed_for_bad_minimal_to_bad_moderate(sidewalks_gdf):
     """
@@ -117,12 +89,10 @@ def safe_format(value):
     return value
 
 def get_basic_statistics(sidewalks_gdf, benches_gdf, district, heatmap_file):
-    # Reproject to a suitable projected CRS for accurate length and area calculations
-    sidewalks_gdf = sidewalks_gdf.to_crs(epsg=3857)
-    district = district.to_crs(epsg=3857)
+    # All frames are in the metric CRS of the analysis, lengths are in metres
 
-    avg_nearest_bench_distance, avg_max_nearest_bench_distance, avg_of_all_averages = (
-        calculate_average_nearest_bench_distance(sidewalks_gdf)
+    bench_distances, sidewalk_distances = calculate_nearest_bench_distances(
+        sidewalks_gdf, benches_gdf
     )
 
     # Classify sidewalks by friendliness and bench count
@@ -139,14 +109,14 @@ def get_basic_statistics(sidewalks_gdf, benches_gdf, district, heatmap_file):
     ]
 
     # Calculate length and percentage statistics
-    total_length = sidewalks_gdf["length"].sum() * 111320 / 1000
-    good_length = good_streets["length"].sum() * 111320 / 1000
-    okay_length = okay_streets["length"].sum() * 111320 / 1000
-    insufficient_length = insufficient_streets["length"].sum() * 111320 / 1000
+    total_length = sidewalks_gdf["length"].sum() / 1000
+    good_length = good_streets["length"].sum() / 1000
+    okay_length = okay_streets["length"].sum() / 1000
+    insufficient_length = insufficient_streets["length"].sum() / 1000
     insufficient_minimal_length = (
-        insufficient_minimal_streets["length"].sum() * 111320 / 1000
+        insufficient_minimal_streets["length"].sum() / 1000
     )
-    non_age_friendly_length = non_age_friendly_streets["length"].sum() * 111320 / 1000
+    non_age_friendly_length = non_age_friendly_streets["length"].sum() / 1000
 
     percent_good = (good_length / total_length) * 100
     percent_okay = (okay_length / total_length) * 100
@@ -174,29 +144,18 @@ def get_basic_statistics(sidewalks_gdf, benches_gdf, district, heatmap_file):
         # Calculate total area of the district in square meters
     raw_total_area = district.geometry.area.sum() 
 
-    total_area = raw_total_area * 0.3728 # sry 
-
     # Convert total area to square kilometers
-    total_area_km2 = total_area / 1e6  # Convert area to km²
+    total_area_km2 = raw_total_area / 1e6  # Convert area to km²
 
     if not heatmap_file:
         density = 'N/A'
         total_seniors = 'N/A'
     else:
-        density_df = pd.read_excel(heatmap_file)
-
-        # Ensure the density_df has the correct columns
-        if not {"OBJECTID", "LICZBA", "boundaries"}.issubset(density_df.columns):
-            raise KeyError(
-                "The 'heatmap.xlsx' file is missing required columns: 'OBJECTID', 'LICZBA', 'boundaries'."
-            )
-
-        # Create geometries from the 'boundaries' column
-        density_df["geometry"] = density_df["boundaries"].apply(parse_multilinestring)
-        density_gdf = gpd.GeoDataFrame(density_df, geometry="geometry", crs="EPSG:4326")
+        # Load the compiled density information around the district
+        density_gdf = load_heatmap(heatmap_file, bbox=to_wgs84(district).total_bounds)
 
         # Reproject to match the district CRS
-        density_gdf = density_gdf.to_crs(epsg=3857)
+        density_gdf = density_gdf.to_crs(district.crs)
 
         # Calculate total seniors within the district
         district_seniors = density_gdf[density_gdf.within(district.geometry.iloc[0])]
@@ -256,6 +215,13 @@ def get_basic_statistics(sidewalks_gdf, benches_gdf, district, heatmap_file):
                 "Number of Street Segments",
                 "Current Number of Benches",
                 "Average of Distance to the Nearest Bench (m)",
+                "Median Distance to the Nearest Bench (m)",
+                "90th Percentile Distance to the Nearest Bench (m)",
+                "Maximum Distance to the Nearest Bench (m)",
+                "Average Distance from Sidewalks to the Nearest Bench (m)",
+                "Median Distance from Sidewalks to the Nearest Bench (m)",
+                "90th Percentile Distance from Sidewalks to the Nearest Bench (m)",
+                "Maximum Distance from Sidewalks to the Nearest Bench (m)",
                 "Number of Seniors (aged 60+)",
                 "Density of Seniors (no. of seniors/km²)",
                 "Overall Friendliness",
@@ -265,7 +231,14 @@ def get_basic_statistics(sidewalks_gdf, benches_gdf, district, heatmap_file):
                 safe_format(total_length),
                 f"{number_of_street_segments}",
                 f"{current_benches}",
-                safe_format(avg_nearest_bench_distance),
+                safe_format(bench_distances["mean"]),
+                safe_format(bench_distances["median"]),
+                safe_format(bench_distances["p90"]),
+                safe_format(bench_distances["max"]),
+                safe_format(sidewalk_distances["mean"]),
+                safe_format(sidewalk_distances["median"]),
+                safe_format(sidewalk_distances["p90"]),
+                safe_format(sidewalk_distances["max"]),
                 f"{total_seniors}",
                 safe_format(density),
                 safe_format(overall_friendliness) + "%",